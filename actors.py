@@ -0,0 +1,186 @@
+import asyncio
+import os
+import time
+from pymongo.errors import PyMongoError
+from prometheus_client import Counter, Gauge, Histogram
+from storage import store, now, count_result
+
+# With GAME_ACTORS=1 every game that receives a move is owned by an actor in this process. Moves
+# and other changes are checked and applied to the actor's copy in memory, and all the changes
+# since the last pass are written in one bulk write every ACTOR_FLUSH_SECONDS; a crash loses at
+# most that window. Each write is conditional on the version the database last saw, so a game
+# changed by anyone else is reloaded rather than overwritten. Only for deployments where one
+# process serves all the moves of a game.
+GAME_ACTORS = os.getenv("GAME_ACTORS", "0") == "1"
+ACTOR_FLUSH_SECONDS = float(os.getenv("ACTOR_FLUSH_SECONDS", "0.1"))
+ACTOR_IDLE_SECONDS = float(os.getenv("ACTOR_IDLE_SECONDS", "60"))
+
+actors_active = Gauge("game_actors_active", "Games owned by an actor in this process")
+actor_flush_seconds = Histogram("game_actor_flush_seconds", "Time spent writing actor changes to the database")
+actor_flushed_games = Counter("game_actor_flushed_games_total", "Game writes made by actor flushes")
+actor_conflicts = Counter("game_actor_conflicts_total", "Actor writes dropped because the game changed elsewhere")
+
+actors = {}
+flush_lock = asyncio.Lock()
+flusher = None
+
+
+class GameActor:
+    def __init__(self, game_id: str):
+        self.game_id = game_id
+        self.game = None
+        # the version in the database, and what changed since
+        self.saved_version = None
+        self.changes = {}
+        self.new_moves = []
+        self.result = None
+        # the result of the game as written, until it is counted
+        self.written_result = None
+        self.last_used = time.monotonic()
+        self.ready = asyncio.ensure_future(self.load())
+
+    async def load(self):
+        game = await store.find_game(self.game_id)
+        if game is None:
+            return False
+        self.game = game
+        self.saved_version = game["version"]
+        return True
+
+    def change(self, changes: dict):
+        changes = {**changes, "version": self.game["version"] + 1, "updated_at": now()}
+        self.game.update(changes)
+        self.changes.update(changes)
+        self.last_used = time.monotonic()
+
+    def apply_move(self, changes: dict, move: dict):
+        # the move was checked against self.game, with nothing awaited since
+        self.new_moves.append(move)
+        self.change(changes)
+        if changes["state"] != "ongoing":
+            # the result is counted once the game that has it is written
+            self.result = changes["state"]
+        return dict(self.game)
+
+    def update(self, version: int, changes: dict):
+        if self.game["version"] != version:
+            return False
+        self.change(changes)
+        return True
+
+    def take_pending(self):
+        pending = (self.saved_version, self.changes, self.new_moves, self.result)
+        self.saved_version = self.changes["version"]
+        self.changes, self.new_moves, self.result = {}, [], None
+        return pending
+
+    def restore_pending(self, pending: tuple):
+        # a flush that failed is retried with whatever changed since
+        self.saved_version = pending[0]
+        self.changes = {**pending[1], **self.changes}
+        self.new_moves = pending[2] + self.new_moves
+        self.result = self.result or pending[3]
+
+
+async def find_actor(game_id: str):
+    # the actor of a game if it has one, already loaded
+    actor = actors.get(game_id)
+    if actor is None or not await asyncio.shield(actor.ready):
+        return None
+    return actor
+
+
+async def actor_for(game_id: str):
+    # the actor of a game, started if the game has none yet; None if there is no such game
+    actor = actors.get(game_id)
+    if actor is None:
+        actor = actors[game_id] = GameActor(game_id)
+        actors_active.set(len(actors))
+    try:
+        loaded = await asyncio.shield(actor.ready)
+    except Exception:
+        drop(actor)
+        raise
+    if not loaded:
+        drop(actor)
+        return None
+    return actor
+
+
+def drop(actor: GameActor):
+    if actors.get(actor.game_id) is actor:
+        del actors[actor.game_id]
+        actors_active.set(len(actors))
+
+
+async def flush():
+    async with flush_lock:
+        dirty = [actor for actor in actors.values() if actor.changes]
+        if dirty:
+            await write_changes(dirty)
+
+        # each result is counted on its own, so one that fails holds up no other; it stays on its actor
+        # for the next flush, and the archiver counts it if the actor is gone by then
+        for actor in [actor for actor in actors.values() if actor.written_result is not None]:
+            try:
+                await count_result(actor.game)
+            except PyMongoError:
+                continue
+            actor.written_result = None
+
+
+async def write_changes(dirty: list):
+    batch = [(actor, actor.take_pending()) for actor in dirty]
+    updates = [(actor.game["_id"], version, changes, new_moves)
+               for actor, (version, changes, new_moves, result) in batch]
+    try:
+        with actor_flush_seconds.time():
+            conflicts = await store.persist_games(updates)
+    except BaseException:
+        # a write that did land after all makes the retry a conflict, never a second copy
+        for actor, pending in batch:
+            actor.restore_pending(pending)
+        raise
+    actor_flushed_games.inc(len(updates) - len(conflicts))
+
+    for actor, (version, changes, new_moves, result) in batch:
+        if actor.game["_id"] in conflicts:
+            # someone else changed the game, what this actor holds is stale
+            actor_conflicts.inc()
+            drop(actor)
+        elif result is not None:
+            actor.written_result = result
+
+
+def evict_idle():
+    cutoff = time.monotonic() - ACTOR_IDLE_SECONDS
+    for actor in [actor for actor in actors.values() if actor.last_used < cutoff and not actor.changes
+                  and actor.written_result is None]:
+        drop(actor)
+
+
+async def run_flusher():
+    while True:
+        await asyncio.sleep(ACTOR_FLUSH_SECONDS)
+        try:
+            await flush()
+        except PyMongoError:
+            # the changes are kept and written on the next pass
+            pass
+        evict_idle()
+
+
+async def start_actors():
+    global flusher
+    if GAME_ACTORS:
+        flusher = asyncio.create_task(run_flusher())
+
+
+async def stop_actors():
+    if flusher is not None:
+        flusher.cancel()
+        try:
+            await flusher
+        except asyncio.CancelledError:
+            pass
+        await flush()
@@ -0,0 +1,92 @@
+import asyncio
+import os
+from datetime import timedelta
+from pymongo.errors import PyMongoError
+from prometheus_client import Counter
+from storage import store, now, count_result
+from cache import game_cache
+from events import publish, game_channel
+from bot import BOT_USERNAME
+
+# Every ARCHIVE_INTERVAL_SECONDS, ongoing games without a move for GAME_TIMEOUT_SECONDS are ended
+# as timed_out, results that weren't counted when their game was decided are counted, and games
+# finished ARCHIVE_AFTER_SECONDS ago, long enough for players to see the result and play again, are
+# moved to game_history once their result is counted. Games left waiting BOT_STALLED_SECONDS on a
+# computer move, because its attempts failed or the worker making it stopped, are handed back to the
+# bot. Every step is conditional, so any number of
+# workers can run the archiver at once.
+ARCHIVE_INTERVAL_SECONDS = float(os.getenv("ARCHIVE_INTERVAL_SECONDS", "60"))
+GAME_TIMEOUT_SECONDS = int(os.getenv("GAME_TIMEOUT_SECONDS", "86400"))
+ARCHIVE_AFTER_SECONDS = int(os.getenv("ARCHIVE_AFTER_SECONDS", "3600"))
+ARCHIVE_BATCH_SIZE = int(os.getenv("ARCHIVE_BATCH_SIZE", "100"))
+BOT_STALLED_SECONDS = int(os.getenv("BOT_STALLED_SECONDS", "30"))
+
+games_timed_out = Counter("games_timed_out_total", "Ongoing games ended because nobody moved")
+games_archived = Counter("games_archived_total", "Finished games moved to the game history")
+results_recounted = Counter("game_results_recounted_total", "Game results counted by the archiver after being missed")
+
+archiver = None
+# called with each game waiting on the bot, set by start_archiver
+resume_bot_game = None
+
+
+async def time_out_stale_games():
+    cutoff = now() - timedelta(seconds=GAME_TIMEOUT_SECONDS)
+    for game_id in await store.find_stale_games(cutoff, ARCHIVE_BATCH_SIZE):
+        game = await store.time_out_game(game_id, cutoff)
+        if game is not None:
+            game_cache.put(game)
+            games_timed_out.inc()
+            await publish(game_channel(str(game_id)), {"event": "state_change", "game_state": game["state"]})
+
+
+async def count_missed_results():
+    # a game decided less than a pass ago may still be counted by the request that decided it
+    cutoff = now() - timedelta(seconds=ARCHIVE_INTERVAL_SECONDS)
+    for game in await store.find_unrecorded_games(cutoff, ARCHIVE_BATCH_SIZE):
+        await count_result(game)
+        results_recounted.inc()
+
+
+async def resume_bot_games():
+    cutoff = now() - timedelta(seconds=BOT_STALLED_SECONDS)
+    for game in await store.find_bot_turn_games(BOT_USERNAME, cutoff, ARCHIVE_BATCH_SIZE):
+        resume_bot_game(game)
+
+
+async def archive_finished_games():
+    cutoff = now() - timedelta(seconds=ARCHIVE_AFTER_SECONDS)
+    for game in await store.find_finished_games(cutoff, ARCHIVE_BATCH_SIZE):
+        if await store.archive_game(game):
+            game_cache.invalidate(str(game["_id"]))
+            games_archived.inc()
+
+
+async def archive_once():
+    await store.expire_entries()
+    await time_out_stale_games()
+    await count_missed_results()
+    if resume_bot_game is not None:
+        await resume_bot_games()
+    await archive_finished_games()
+
+
+async def run_archiver():
+    while True:
+        try:
+            await archive_once()
+        except PyMongoError:
+            # the next pass picks up where this one failed
+            pass
+        await asyncio.sleep(ARCHIVE_INTERVAL_SECONDS)
+
+
+async def start_archiver(on_bot_turn=None):
+    global archiver, resume_bot_game
+    resume_bot_game = on_bot_turn
+    archiver = asyncio.create_task(run_archiver())
+
+
+async def stop_archiver():
+    if archiver is not None:
+        archiver.cancel()
@@ -0,0 +1,73 @@
+import os
+import secrets
+import time
+from collections import OrderedDict
+import jwt
+from dotenv import load_dotenv
+from fastapi import Depends
+from fastapi.exceptions import HTTPException
+from fastapi.security import OAuth2PasswordBearer
+
+load_dotenv()
+
+# JWT_KEYS is a comma separated list of "key_id:secret" pairs shared by all workers and nodes.
+# New tokens are signed with JWT_ACTIVE_KEY_ID, the other keys are still accepted, so a key is
+# rotated by adding a new one, making it active, and removing the old one once its tokens expired.
+TOKEN_TTL_SECONDS = int(os.getenv("TOKEN_TTL_SECONDS", "86400"))
+TOKEN_CACHE_SIZE = int(os.getenv("TOKEN_CACHE_SIZE", "10000"))
+
+oauth2_scheme = OAuth2PasswordBearer(tokenUrl="token")
+
+
+def load_signing_keys():
+    keys = {}
+    for entry in os.getenv("JWT_KEYS", "").split(","):
+        if entry.strip():
+            key_id, _, secret = entry.strip().partition(":")
+            keys[key_id] = secret
+    if not keys:
+        # without shared keys tokens are only valid in the process that issued them
+        keys["local"] = secrets.token_hex(256)
+    return keys
+
+
+signing_keys = load_signing_keys()
+active_key_id = os.getenv("JWT_ACTIVE_KEY_ID", next(iter(signing_keys)))
+if active_key_id not in signing_keys:
+    raise RuntimeError(f"JWT_ACTIVE_KEY_ID {active_key_id} is not in JWT_KEYS")
+
+# token -> (username, expiry), repeated requests with the same token skip the signature check
+verified_tokens = OrderedDict()
+
+
+def generate_token(username):
+    issued_at = int(time.time())
+    payload = {'user': username, 'iat': issued_at, 'exp': issued_at + TOKEN_TTL_SECONDS}
+    token = jwt.encode(payload, signing_keys[active_key_id], algorithm='HS256', headers={'kid': active_key_id})
+    return token
+
+
+def decode_token(token: str):
+    cached = verified_tokens.get(token)
+    if cached is not None and cached[1] > time.time():
+        verified_tokens.move_to_end(token)
+        return cached[0]
+
+    key = signing_keys.get(jwt.get_unverified_header(token).get('kid'))
+    if key is None:
+        raise jwt.InvalidTokenError("Unknown signing key")
+
+    payload = jwt.decode(token, key, algorithms=['HS256'], options={'require': ['exp']})
+    verified_tokens[token] = (payload['user'], payload['exp'])
+    if len(verified_tokens) > TOKEN_CACHE_SIZE:
+        verified_tokens.popitem(last=False)
+    return payload['user']
+
+
+def verify_token(token: str = Depends(oauth2_scheme)):
+    try:
+        return decode_token(token)
+    except jwt.ExpiredSignatureError:
+        raise HTTPException(status_code=400, detail="Signature has expired")
+    except jwt.InvalidTokenError:
+        raise HTTPException(status_code=400, detail="Invalid token")
@@ -0,0 +1,88 @@
+import json
+import random
+import timeit
+import orjson
+from game import (cell_index, check_if_won, determine_state, determine_state_full_scan, winning_masks,
+                  winning_masks_by_cell, board_to_grid, board_to_rows, board_to_base64)
+
+REPEAT = 5
+NUMBER = 200
+
+
+def random_position(size: int, fill: float, seed):
+    rng = random.Random(seed)
+    x_board = o_board = 0
+    cells = [cell_index(row, column) for row in range(size) for column in range(size)]
+    rng.shuffle(cells)
+    move_count = max(1, int(len(cells) * fill))
+    for i, index in enumerate(cells[:move_count]):
+        if i % 2 == 0:
+            x_board |= 1 << index
+        else:
+            o_board |= 1 << index
+    return x_board, o_board, cells[move_count - 1], move_count
+
+
+def best_of(statement):
+    return min(timeit.repeat(statement, repeat=REPEAT, number=NUMBER)) / NUMBER
+
+
+def bench_check_if_won():
+    print("check_if_won on a board without a win (microseconds per call)")
+    print(f"{'size':>4} {'line':>4} {'masks':>6} {'time':>10}")
+    for size in (3, 4, 5, 6, 8, 10, 12, 15, 20, 26):
+        for winning_line in sorted({3, min(size, 5), size}):
+            masks = len(winning_masks(size, winning_line))
+            x_board, o_board, _, _ = random_position(size, 0.3, seed=size)
+            while check_if_won(x_board, size, winning_line):
+                x_board, o_board, _, _ = random_position(size, 0.3, seed=random.random())
+            timing = best_of(lambda: check_if_won(x_board, size, winning_line))
+            print(f"{size:>4} {winning_line:>4} {masks:>6} {timing * 1e6:>10.2f}")
+
+
+def bench_determine_state():
+    print("determine_state: full scan vs. lines through last move (microseconds per call)")
+    print(f"{'size':>4} {'line':>4} {'full scan':>12} {'last move':>12} {'speedup':>8}")
+    for size in range(3, 27):
+        winning_line = min(size, 5)
+        # masks are cached per (size, winning_line), keep building them out of the timings
+        winning_masks_by_cell(size, winning_line)
+
+        x_board, o_board, index, move_count = random_position(size, 0.3, seed=size)
+        # a position without a win is the worst case for the full scan
+        while determine_state_full_scan(x_board, o_board, size, winning_line) != "ongoing":
+            x_board, o_board, index, move_count = random_position(size, 0.3, seed=random.random())
+        x_moved = move_count % 2 == 1
+        board = x_board if x_moved else o_board
+
+        full = best_of(lambda: determine_state_full_scan(x_board, o_board, size, winning_line))
+        incremental = best_of(lambda: determine_state(board, size, winning_line, index, x_moved, move_count))
+        print(f"{size:>4} {winning_line:>4} {full * 1e6:>12.2f} {incremental * 1e6:>12.2f} {full / incremental:>7.1f}x")
+
+
+def bench_grid_encoding():
+    print("get_full_game_state grid encodings: microseconds to build and serialize, payload bytes")
+    print(f"{'size':>4} {'list json':>10} {'list orjson':>12} {'rows orjson':>12} {'bitboard':>10}"
+          f" {'list B':>8} {'rows B':>8} {'bitboard B':>10}")
+    for size in range(3, 27):
+        x_board, o_board, _, _ = random_position(size, 0.5, seed=size)
+        encodings = {
+            "list json": lambda: json.dumps(board_to_grid(x_board, o_board, size)).encode(),
+            "list orjson": lambda: orjson.dumps(board_to_grid(x_board, o_board, size)),
+            "rows orjson": lambda: orjson.dumps(board_to_rows(x_board, o_board, size)),
+            "bitboard": lambda: orjson.dumps({"x": board_to_base64(x_board, size),
+                                              "o": board_to_base64(o_board, size)})
+        }
+        timings = {name: best_of(encode) for name, encode in encodings.items()}
+        sizes = {name: len(encode()) for name, encode in encodings.items()}
+        print(f"{size:>4} {timings['list json'] * 1e6:>10.2f} {timings['list orjson'] * 1e6:>12.2f}"
+              f" {timings['rows orjson'] * 1e6:>12.2f} {timings['bitboard'] * 1e6:>10.2f}"
+              f" {sizes['list orjson']:>8} {sizes['rows orjson']:>8} {sizes['bitboard']:>10}")
+
+
+if __name__ == "__main__":
+    bench_check_if_won()
+    print()
+    bench_determine_state()
+    print()
+    bench_grid_encoding()
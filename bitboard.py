@@ -0,0 +1,54 @@
+from functools import lru_cache
+
+# Boards are stored as integer bitboards, one per side. Cell (row, column) is bit
+# row * MAX_GRID_SIZE + column, so a cell maps to the same bit for every grid size.
+# Mongo only stores 64-bit signed integers, so boards are persisted as lists of
+# WORD_BITS-bit words.
+MAX_GRID_SIZE = 26
+WORD_BITS = 63
+WORD_MASK = (1 << WORD_BITS) - 1
+
+
+def cell_index(row: int, column: int):
+    return row * MAX_GRID_SIZE + column
+
+
+def board_to_words(board: int, size: int):
+    word_count = cell_index(size - 1, size - 1) // WORD_BITS + 1
+    return [(board >> (k * WORD_BITS)) & WORD_MASK for k in range(word_count)]
+
+
+def board_from_words(words: list):
+    board = 0
+    for k, word in enumerate(words):
+        board |= word << (k * WORD_BITS)
+    return board
+
+
+@lru_cache(maxsize=64)
+def winning_masks(size: int, winning_line: int):
+    masks = []
+    for d_row, d_column in ((0, 1), (1, 0), (1, 1), (1, -1)):
+        for row in range(size):
+            for column in range(size):
+                end_row = row + d_row * (winning_line - 1)
+                end_column = column + d_column * (winning_line - 1)
+                if 0 <= end_row < size and 0 <= end_column < size:
+                    mask = 0
+                    for k in range(winning_line):
+                        mask |= 1 << cell_index(row + d_row * k, column + d_column * k)
+                    masks.append(mask)
+    return tuple(masks)
+
+
+@lru_cache(maxsize=64)
+def winning_masks_by_cell(size: int, winning_line: int):
+    # for every cell, the winning lines that pass through it
+    by_cell = {cell_index(row, column): [] for row in range(size) for column in range(size)}
+    for mask in winning_masks(size, winning_line):
+        cells = mask
+        while cells:
+            lowest = cells & -cells
+            by_cell[lowest.bit_length() - 1].append(mask)
+            cells ^= lowest
+    return {index: tuple(masks) for index, masks in by_cell.items()}
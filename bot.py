@@ -0,0 +1,230 @@
+import asyncio
+import multiprocessing
+import os
+import random
+import time
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from functools import lru_cache
+from prometheus_client import Histogram
+from bitboard import MAX_GRID_SIZE, cell_index, winning_masks, winning_masks_by_cell
+
+# The computer opponent searches in worker processes, so its thinking never holds up the event loop.
+# Workers are spawned rather than forked from a process that already runs threads, and only load
+# this module and bitboard.py.
+BOT_USERNAME = os.getenv("BOT_USERNAME", "computer")
+BOT_MOVE_SECONDS = float(os.getenv("BOT_MOVE_SECONDS", "1"))
+BOT_MAX_DEPTH = int(os.getenv("BOT_MAX_DEPTH", "12"))
+BOT_WORKERS = int(os.getenv("BOT_WORKERS", "1"))
+BOT_TABLE_SIZE = int(os.getenv("BOT_TABLE_SIZE", "1000000"))
+# a move that fails is tried again this many times in all, BOT_RETRY_SECONDS apart
+BOT_MOVE_ATTEMPTS = int(os.getenv("BOT_MOVE_ATTEMPTS", "3"))
+BOT_RETRY_SECONDS = float(os.getenv("BOT_RETRY_SECONDS", "1"))
+
+
+def new_pool():
+    return ProcessPoolExecutor(max_workers=BOT_WORKERS, mp_context=multiprocessing.get_context("spawn"))
+
+
+executor = new_pool()
+
+bot_move_seconds = Histogram("bot_move_seconds", "Time the computer opponent took to choose a move")
+
+# a line with k stones of one side and none of the other is worth 8 ** k to that side
+WIN_SCORE = 1 << (3 * MAX_GRID_SIZE + 3)
+EXACT, LOWER_BOUND, UPPER_BOUND = 0, 1, 2
+NODES_PER_CLOCK_CHECK = 256
+
+FIRST_COLUMN = sum(1 << cell_index(row, 0) for row in range(MAX_GRID_SIZE))
+LAST_COLUMN = sum(1 << cell_index(row, MAX_GRID_SIZE - 1) for row in range(MAX_GRID_SIZE))
+
+# Zobrist keys for a stone of either side on every cell; the side to move follows from the
+# stone counts, so the position hash doesn't need a key for it
+zobrist_random = random.Random(MAX_GRID_SIZE)
+ZOBRIST = [(zobrist_random.getrandbits(64), zobrist_random.getrandbits(64))
+           for _ in range(MAX_GRID_SIZE * MAX_GRID_SIZE)]
+
+
+class OutOfTime(Exception):
+    pass
+
+
+@lru_cache(maxsize=64)
+def grid_mask(size: int):
+    return sum(((1 << size) - 1) << cell_index(row, 0) for row in range(size))
+
+
+def distance(a: int, b: int):
+    a_row, a_column = divmod(a, MAX_GRID_SIZE)
+    b_row, b_column = divmod(b, MAX_GRID_SIZE)
+    return max(abs(a_row - b_row), abs(a_column - b_column))
+
+
+class Search:
+    # Negamax alpha-beta with iterative deepening. The evaluation is kept up to date on every move
+    # by rescoring only the winning lines through the cell that changed.
+    def __init__(self, x_board: int, o_board: int, size: int, winning_line: int, deadline: float):
+        self.boards = [x_board, o_board]
+        self.size = size
+        self.masks_by_cell = winning_masks_by_cell(size, winning_line)
+        self.weights = [0] + [1 << (3 * k) for k in range(1, winning_line)] + [WIN_SCORE]
+        self.grid = grid_mask(size)
+        self.deadline = deadline
+        self.nodes = 0
+        self.table = {}
+
+        self.hash = 0
+        for side, board in enumerate(self.boards):
+            cells = board
+            while cells:
+                lowest = cells & -cells
+                self.hash ^= ZOBRIST[lowest.bit_length() - 1][side]
+                cells ^= lowest
+        self.score = sum(self.line_value(mask) for mask in winning_masks(size, winning_line))
+
+    def line_value(self, mask: int):
+        x_count = bin(self.boards[0] & mask).count("1")
+        o_count = bin(self.boards[1] & mask).count("1")
+        if x_count and o_count:
+            return 0
+        return self.weights[x_count] - self.weights[o_count]
+
+    def play(self, index: int, side: int):
+        masks = self.masks_by_cell[index]
+        before = sum(self.line_value(mask) for mask in masks)
+        self.boards[side] |= 1 << index
+        self.score += sum(self.line_value(mask) for mask in masks) - before
+        self.hash ^= ZOBRIST[index][side]
+
+    def undo(self, index: int, side: int, score: int):
+        self.boards[side] ^= 1 << index
+        self.score = score
+        self.hash ^= ZOBRIST[index][side]
+
+    def won(self, index: int, side: int):
+        board = self.boards[side]
+        return any(board & mask == mask for mask in self.masks_by_cell[index])
+
+    def moves(self, last_index: int, first: int):
+        # empty cells next to a stone, the cells around the last move first
+        occupied = self.boards[0] | self.boards[1]
+        if not occupied:
+            return [cell_index(self.size // 2, self.size // 2)]
+
+        near = occupied | ((occupied << 1) & ~FIRST_COLUMN) | ((occupied >> 1) & ~LAST_COLUMN)
+        near |= (near << MAX_GRID_SIZE) | (near >> MAX_GRID_SIZE)
+        cells = near & self.grid & ~occupied
+        moves = []
+        while cells:
+            lowest = cells & -cells
+            moves.append(lowest.bit_length() - 1)
+            cells ^= lowest
+        if last_index is not None:
+            moves.sort(key=lambda index: distance(index, last_index))
+        if first is not None and first in moves:
+            moves.remove(first)
+            moves.insert(0, first)
+        return moves
+
+    def negamax(self, depth: int, alpha: int, beta: int, side: int, last_index: int, ply: int):
+        self.nodes += 1
+        if self.nodes % NODES_PER_CLOCK_CHECK == 0 and time.monotonic() > self.deadline:
+            raise OutOfTime()
+
+        entry = self.table.get(self.hash)
+        best_known = None
+        if entry is not None:
+            entry_depth, entry_score, entry_bound, best_known = entry
+            if entry_depth >= depth:
+                if entry_bound == EXACT:
+                    return entry_score
+                elif entry_bound == LOWER_BOUND:
+                    alpha = max(alpha, entry_score)
+                else:
+                    beta = min(beta, entry_score)
+                if alpha >= beta:
+                    return entry_score
+
+        if depth == 0:
+            return self.score if side == 0 else -self.score
+
+        moves = self.moves(last_index, best_known)
+        if not moves:
+            return 0
+
+        original_alpha = alpha
+        best_score = -WIN_SCORE * 2
+        best_move = moves[0]
+        for index in moves:
+            score = self.score
+            self.play(index, side)
+            if self.won(index, side):
+                # sooner wins score higher
+                result = WIN_SCORE - ply
+            else:
+                result = -self.negamax(depth - 1, -beta, -alpha, 1 - side, index, ply + 1)
+            self.undo(index, side, score)
+
+            if result > best_score:
+                best_score, best_move = result, index
+            alpha = max(alpha, result)
+            if alpha >= beta:
+                break
+
+        if len(self.table) >= BOT_TABLE_SIZE:
+            self.table.clear()
+        bound = UPPER_BOUND if best_score <= original_alpha else LOWER_BOUND if best_score >= beta else EXACT
+        self.table[self.hash] = (depth, best_score, bound, best_move)
+        return best_score
+
+    def best_move(self, last_index: int):
+        side = 0 if bin(self.boards[0]).count("1") == bin(self.boards[1]).count("1") else 1
+        moves = self.moves(last_index, None)
+        best = moves[0]
+        if len(moves) == 1:
+            return best
+
+        for depth in range(1, BOT_MAX_DEPTH + 1):
+            try:
+                score = self.negamax(depth, -WIN_SCORE * 2, WIN_SCORE * 2, side, last_index, 0)
+            except OutOfTime:
+                break
+            best = self.table[self.hash][3]
+            if abs(score) >= WIN_SCORE - BOT_MAX_DEPTH:
+                # a forced win or loss was found, searching deeper doesn't change the move
+                break
+        return best
+
+
+def search(x_board: int, o_board: int, size: int, winning_line: int, last_index: int, seconds: float):
+    return Search(x_board, o_board, size, winning_line, time.monotonic() + seconds).best_move(last_index)
+
+
+async def choose_move(x_board: int, o_board: int, size: int, winning_line: int, last_index: int):
+    loop = asyncio.get_running_loop()
+    with bot_move_seconds.time():
+        try:
+            return await loop.run_in_executor(executor, search, x_board, o_board, size, winning_line, last_index,
+                                              BOT_MOVE_SECONDS)
+        except BrokenProcessPool:
+            # a worker died and the pool can't be used again; a new pool takes the next moves, and this
+            # one is chosen here by a search that gives up at its first clock check
+            restart_bot_pool()
+            return search(x_board, o_board, size, winning_line, last_index, 0)
+
+
+async def start_bot_pool():
+    # workers are spawned on first use, and starting one and importing this module in it takes longer
+    # than a move's time budget, so they are all started before the first move
+    loop = asyncio.get_running_loop()
+    await asyncio.gather(*(loop.run_in_executor(executor, os.getpid) for _ in range(BOT_WORKERS)))
+
+
+def restart_bot_pool():
+    global executor
+    executor.shutdown(wait=False, cancel_futures=True)
+    executor = new_pool()
+
+
+def close_bot_pool():
+    executor.shutdown(wait=False, cancel_futures=True)
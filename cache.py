@@ -0,0 +1,63 @@
+import os
+import time
+from collections import OrderedDict
+from prometheus_client import Counter, Gauge
+
+# Games are cached per process. Every write goes through the cache, so a worker always
+# sees its own writes; writes from other workers show up once the entry expires, and
+# conditional updates on "version" detect entries that went stale before that.
+GAME_CACHE_SIZE = int(os.getenv("GAME_CACHE_SIZE", "10000"))
+GAME_CACHE_TTL_SECONDS = float(os.getenv("GAME_CACHE_TTL_SECONDS", "2"))
+
+cache_hits = Counter("game_cache_hits_total", "Game lookups served from the cache")
+cache_misses = Counter("game_cache_misses_total", "Game lookups that went to the database")
+cache_evictions = Counter("game_cache_evictions_total", "Games dropped from the cache", ["reason"])
+cache_size = Gauge("game_cache_size", "Games currently cached")
+
+
+class GameCache:
+    def __init__(self, max_size: int, ttl: float):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.entries = OrderedDict()
+
+    def get(self, game_id: str):
+        entry = self.entries.get(game_id)
+        if entry is None:
+            cache_misses.inc()
+            return None
+
+        expires_at, game = entry
+        if expires_at < time.monotonic():
+            self.evict(game_id, "expired")
+            cache_misses.inc()
+            return None
+
+        self.entries.move_to_end(game_id)
+        cache_hits.inc()
+        return dict(game)
+
+    def put(self, game: dict):
+        game_id = str(game["_id"])
+        entry = self.entries.get(game_id)
+        if entry is not None and entry[1]["version"] > game["version"]:
+            # an older read must not replace a newer write
+            return
+
+        self.entries[game_id] = (time.monotonic() + self.ttl, dict(game))
+        self.entries.move_to_end(game_id)
+        while len(self.entries) > self.max_size:
+            self.evict(next(iter(self.entries)), "size")
+        cache_size.set(len(self.entries))
+
+    def invalidate(self, game_id: str):
+        if game_id in self.entries:
+            self.evict(game_id, "invalidated")
+
+    def evict(self, game_id: str, reason: str):
+        del self.entries[game_id]
+        cache_evictions.labels(reason).inc()
+        cache_size.set(len(self.entries))
+
+
+game_cache = GameCache(GAME_CACHE_SIZE, GAME_CACHE_TTL_SECONDS)
@@ -1,46 +1,128 @@
 import os
 from dotenv import load_dotenv
-from pymongo import MongoClient
+from motor.motor_asyncio import AsyncIOMotorClient
+from pymongo import monitoring
 from pymongo.errors import (
     PyMongoError, ConnectionFailure, OperationFailure, ConfigurationError,
     CursorNotFound, DuplicateKeyError, ExecutionTimeout, NetworkTimeout,
     ServerSelectionTimeoutError, WriteError, WriteConcernError
 )
 from fastapi.exceptions import HTTPException
+from prometheus_client import Counter, Histogram
 
 load_dotenv()
 
-client = MongoClient(os.getenv("MONGO_URL"))
-db = client[os.getenv("DB_NAME")]
+# how long declined, cancelled and accepted invitations are kept, and how long a waiting entry
+# or matchmaking ticket lives without being renewed; changing either needs the index dropped first
+INVITATION_RETENTION_SECONDS = int(os.getenv("INVITATION_RETENTION_SECONDS", "3600"))
+WAITING_USER_TTL_SECONDS = int(os.getenv("WAITING_USER_TTL_SECONDS", "1800"))
+
+DB_LATENCY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5)
+
+command_seconds = Histogram("mongo_command_seconds", "Time spent in database commands", ["collection", "command"],
+                            buckets=DB_LATENCY_BUCKETS)
+command_failures = Counter("mongo_command_failures_total", "Database commands that failed", ["collection", "command"])
+db_errors = Counter("db_errors_total", "Database errors turned into HTTP errors", ["error", "status"])
+
+
+class CommandTimer(monitoring.CommandListener):
+    # pymongo reports every command the client sends, on the thread that sent it; the collection
+    # is only in the started event, so it is kept until the command finishes
+    def __init__(self):
+        self.collections = {}
+
+    def started(self, event):
+        collection = event.command.get(event.command_name)
+        if event.command_name == "getMore":
+            collection = event.command.get("collection")
+        self.collections[(event.connection_id, event.request_id)] = \
+            collection if isinstance(collection, str) else event.database_name
+
+    def succeeded(self, event):
+        collection = self.collections.pop((event.connection_id, event.request_id), event.database_name)
+        command_seconds.labels(collection, event.command_name).observe(event.duration_micros / 1e6)
+
+    def failed(self, event):
+        collection = self.collections.pop((event.connection_id, event.request_id), event.database_name)
+        command_seconds.labels(collection, event.command_name).observe(event.duration_micros / 1e6)
+        command_failures.labels(collection, event.command_name).inc()
+
+
+# the client connects lazily, on the first operation awaited inside the running event loop
+client = AsyncIOMotorClient(
+    os.getenv("MONGO_URL"),
+    maxPoolSize=int(os.getenv("MONGO_MAX_POOL_SIZE", "100")),
+    minPoolSize=int(os.getenv("MONGO_MIN_POOL_SIZE", "0")),
+    waitQueueTimeoutMS=int(os.getenv("MONGO_WAIT_QUEUE_TIMEOUT_MS", "5000")),
+    serverSelectionTimeoutMS=int(os.getenv("MONGO_SERVER_SELECTION_TIMEOUT_MS", "5000")),
+    connectTimeoutMS=int(os.getenv("MONGO_CONNECT_TIMEOUT_MS", "5000")),
+    socketTimeoutMS=int(os.getenv("MONGO_SOCKET_TIMEOUT_MS", "10000")),
+    event_listeners=[CommandTimer()]
+)
+db = client[os.getenv("DB_NAME", "tictactoe")]
 
 users = db.users
-users.create_index([("username", 1)], unique=True)
 waiting_users = db.waiting_users
-waiting_users.create_index([("username", 1)], unique=True)
 invitations = db.invitations
 games = db.games
+game_history = db.game_history
+player_stats = db.player_stats
+events = db.events
+
+
+async def init_db():
+    await client.admin.command("ping")
+    await users.create_index([("username", 1)], unique=True)
+    await waiting_users.create_index([("username", 1)], unique=True)
+    await waiting_users.create_index([("matchmaking.size", 1), ("matchmaking.winning_line", 1),
+                                      ("matchmaking.play_again_scheme", 1), ("matched_game_id", 1), ("_id", 1)],
+                                     partialFilterExpression={"matchmaking": {"$exists": True}})
+    await waiting_users.create_index([("waiting_since", 1)], expireAfterSeconds=WAITING_USER_TTL_SECONDS)
+    await invitations.create_index([("invited", 1), ("status", 1), ("_id", 1)])
+    await invitations.create_index([("inviter", 1), ("status", 1), ("_id", 1)])
+    await invitations.create_index([("finished_at", 1)], expireAfterSeconds=INVITATION_RETENTION_SECONDS)
+    await games.create_index([("x_player_name", 1), ("state", 1), ("_id", 1)])
+    await games.create_index([("o_player_name", 1), ("state", 1), ("_id", 1)])
+    await games.create_index([("state", 1), ("updated_at", 1)])
+    await games.create_index([("updated_at", 1)], partialFilterExpression={"result_recorded": False},
+                             name="unrecorded_results")
+    await game_history.create_index([("x_player_name", 1), ("_id", 1)])
+    await game_history.create_index([("o_player_name", 1), ("_id", 1)])
+    await player_stats.create_index([("username", 1), ("size", 1), ("winning_line", 1)], unique=True)
+    await player_stats.create_index([("size", 1), ("winning_line", 1), ("wins", -1), ("username", 1)])
+    await events.create_index([("created_at", 1)], expireAfterSeconds=60)
+
+
+def close_db():
+    client.close()
 
 
 def handle_db_exception(error: PyMongoError):
+    status_code, detail = db_error_response(error)
+    db_errors.labels(type(error).__name__, str(status_code)).inc()
+    raise HTTPException(status_code=status_code, detail=detail)
+
+
+def db_error_response(error: PyMongoError):
     if isinstance(error, ConnectionFailure):
-        raise HTTPException(status_code=503, detail="Database connection failure")
+        return 503, "Database connection failure"
     elif isinstance(error, OperationFailure):
-        raise HTTPException(status_code=500, detail="Database operation failed")
+        return 500, "Database operation failed"
     elif isinstance(error, ConfigurationError):
-        raise HTTPException(status_code=500, detail="Database configuration error")
+        return 500, "Database configuration error"
     elif isinstance(error, CursorNotFound):
-        raise HTTPException(status_code=404, detail="Database error: Cursor not found")
+        return 404, "Database error: Cursor not found"
     elif isinstance(error, DuplicateKeyError):
-        raise HTTPException(status_code=409, detail="Database error: Duplicate key error")
+        return 409, "Database error: Duplicate key error"
     elif isinstance(error, ExecutionTimeout):
-        raise HTTPException(status_code=408, detail="Database error: Execution timeout")
+        return 408, "Database error: Execution timeout"
     elif isinstance(error, NetworkTimeout):
-        raise HTTPException(status_code=504, detail="Database error: Network timeout")
+        return 504, "Database error: Network timeout"
     elif isinstance(error, ServerSelectionTimeoutError):
-        raise HTTPException(status_code=503, detail="Database error: Server selection timeout")
+        return 503, "Database error: Server selection timeout"
     elif isinstance(error, WriteError):
-        raise HTTPException(status_code=500, detail="Database error: Write error occurred")
+        return 500, "Database error: Write error occurred"
     elif isinstance(error, WriteConcernError):
-        raise HTTPException(status_code=500, detail="Database error: Write concern failed")
+        return 500, "Database error: Write concern failed"
     else:
-        raise HTTPException(status_code=500, detail="Unknown database error")
+        return 500, "Unknown database error"
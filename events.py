@@ -0,0 +1,143 @@
+import asyncio
+import os
+from collections import defaultdict
+from datetime import datetime, timezone
+from pymongo.errors import PyMongoError
+from database import events
+
+# EVENT_BACKEND=local delivers events to subscribers in this process only. With
+# EVENT_BACKEND=mongo events are written to the events collection and every process
+# delivers them from a change stream, which needs a replica set.
+EVENT_BACKEND = os.getenv("EVENT_BACKEND", "local")
+SUBSCRIBER_QUEUE_SIZE = int(os.getenv("SUBSCRIBER_QUEUE_SIZE", "64"))
+MAX_WAIT_SECONDS = float(os.getenv("LONG_POLL_MAX_SECONDS", "30"))
+
+subscriptions = defaultdict(set)
+
+
+class Subscription:
+    def __init__(self, channel: str):
+        self.channel = channel
+        self.queue = asyncio.Queue(maxsize=SUBSCRIBER_QUEUE_SIZE)
+        self.dropped = False
+
+    def __enter__(self):
+        subscriptions[self.channel].add(self)
+        return self
+
+    def __exit__(self, *exc_info):
+        unsubscribe(self)
+
+    def deliver(self, event: dict):
+        try:
+            self.queue.put_nowait(event)
+        except asyncio.QueueFull:
+            # a consumer that can't keep up is dropped rather than buffered without bound
+            self.dropped = True
+            unsubscribe(self)
+            self.queue = asyncio.Queue()
+            self.queue.put_nowait(None)
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        event = await self.queue.get()
+        if event is None:
+            raise StopAsyncIteration
+        return event
+
+    async def wait(self, timeout: float):
+        try:
+            return await asyncio.wait_for(self.__anext__(), timeout)
+        except (asyncio.TimeoutError, StopAsyncIteration):
+            return None
+
+
+class LocalBackend:
+    async def start(self):
+        pass
+
+    async def stop(self):
+        pass
+
+    async def publish(self, channel: str, event: dict):
+        deliver(channel, event)
+
+
+class MongoChangeStreamBackend:
+    def __init__(self, collection):
+        self.collection = collection
+        self.watcher = None
+
+    async def start(self):
+        self.watcher = asyncio.create_task(self.watch())
+
+    async def stop(self):
+        if self.watcher is not None:
+            self.watcher.cancel()
+
+    async def publish(self, channel: str, event: dict):
+        await self.collection.insert_one({
+            "channel": channel,
+            "event": event,
+            "created_at": datetime.now(timezone.utc)
+        })
+
+    async def watch(self):
+        while True:
+            try:
+                async with self.collection.watch([{"$match": {"operationType": "insert"}}]) as stream:
+                    async for change in stream:
+                        deliver(change["fullDocument"]["channel"], change["fullDocument"]["event"])
+            except PyMongoError:
+                # events published while reconnecting are lost, long polls fall back to their timeout
+                await asyncio.sleep(1)
+
+
+backend = MongoChangeStreamBackend(events) if EVENT_BACKEND == "mongo" else LocalBackend()
+
+
+def subscribe(channel: str):
+    return Subscription(channel)
+
+
+def unsubscribe(subscription: Subscription):
+    channel_subscriptions = subscriptions.get(subscription.channel)
+    if channel_subscriptions is not None:
+        channel_subscriptions.discard(subscription)
+        if not channel_subscriptions:
+            del subscriptions[subscription.channel]
+
+
+def deliver(channel: str, event: dict):
+    for subscription in list(subscriptions.get(channel, ())):
+        subscription.deliver(event)
+
+
+async def publish(channel: str, event: dict):
+    await backend.publish(channel, event)
+
+
+async def start_events():
+    await backend.start()
+
+
+async def stop_events():
+    await backend.stop()
+
+
+def game_channel(game_id: str):
+    return f"game:{game_id}"
+
+
+def invitations_channel(username: str):
+    return f"invitations:{username}"
+
+
+def invitation_channel(invitation_id: str):
+    return f"invitation:{invitation_id}"
+
+
+def matchmaking_channel(username: str):
+    return f"matchmaking:{username}"
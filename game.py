@@ -1,7 +1,21 @@
-from database import games
+import base64
+import secrets
+from bson import ObjectId
+from prometheus_client import Histogram
+from bitboard import MAX_GRID_SIZE, cell_index, board_to_words, board_from_words, winning_masks, winning_masks_by_cell
+from pymongo.errors import PyMongoError
+from storage import store, move_position, count_result
+from cache import game_cache
+from actors import GAME_ACTORS, find_actor, actor_for, flush
 
+ROW_CHARACTERS = str.maketrans("012", ".XO")
 
-def create_game(x_player: str, o_player: str, size: int, winning_line: int, play_again_scheme: str):
+determine_state_seconds = Histogram("determine_state_seconds", "Time spent working out the state after a move",
+                                    buckets=(1e-6, 2.5e-6, 5e-6, 1e-5, 2.5e-5, 5e-5, 1e-4, 2.5e-4, 5e-4, 1e-3, 1e-2))
+
+
+async def create_game(x_player: str, o_player: str, size: int, winning_line: int, play_again_scheme: str,
+                      game_id: ObjectId = None, public: bool = False):
     new_game = {
         "x_player_name": x_player,
         "o_player_name": o_player,
@@ -9,76 +23,226 @@ def create_game(x_player: str, o_player: str, size: int, winning_line: int, play
             "size": size,
             "winning_line": winning_line
         },
-        "grid_state": [['' for _ in range(size)] for _ in range(size)],
+        "x_board": board_to_words(0, size),
+        "o_board": board_to_words(0, size),
         "x_turn": True,
+        "move_count": 0,
+        "moves": [],
+        "version": 0,
         "last_move": None,
         "state": "ongoing",
         "play_again_scheme": play_again_scheme,
         "play_again_status": None,
         "next_game_id": None,
-        "switch_sides": None
+        "switch_sides": None,
+        "public": public,
+        "spectator_key": secrets.token_urlsafe(16)
     }
+    if game_id is not None:
+        new_game["_id"] = game_id
 
-    game_id = str(games.insert_one(new_game).inserted_id)
+    game_id = await store.insert_game(new_game)
+    del new_game["moves"]
+    game_cache.put(new_game)
     return game_id
 
 
-def check_if_valid_move(grid: list, cell: str):
+async def find_game(game_id: str, fresh: bool = False):
+    actor = await find_actor(game_id) if GAME_ACTORS else None
+    if actor is not None:
+        return dict(actor.game)
+
+    game = None if fresh else game_cache.get(game_id)
+    if game is None:
+        game = await store.find_game(game_id)
+        if game is not None:
+            game_cache.put(game)
+    return game
+
+
+async def find_games(game_ids: list):
+    # cached games are served from the cache, all the others are read with a single query
+    found = {}
+    missing = []
+    for game_id in game_ids:
+        actor = await find_actor(game_id) if GAME_ACTORS else None
+        game = dict(actor.game) if actor is not None else game_cache.get(game_id)
+        if game is None:
+            missing.append(game_id)
+        else:
+            found[game_id] = game
+
+    if missing:
+        for game in await store.find_games(missing):
+            game_cache.put(game)
+            found[str(game["_id"])] = game
+    return found
+
+
+async def update_game(game: dict, changes: dict):
+    # applies changes only if the game is still at the version that was read, and writes them through
+    # to the cache; returns False if the game changed in the meantime
+    actor = await find_actor(str(game["_id"])) if GAME_ACTORS else None
+    if actor is not None:
+        if not actor.update(game["version"], changes):
+            return False
+        game.update(changes)
+        game["version"] += 1
+        return True
+
+    if not await store.update_game(game["_id"], game["version"], changes):
+        game_cache.invalidate(str(game["_id"]))
+        return False
+
+    game.update(changes)
+    game["version"] += 1
+    game_cache.put(game)
+    return True
+
+
+def play_move(game: dict, username: str, cell: str, index: int):
+    # the changes the move makes to the game as read, with the state it leads to, and its log entry;
+    # None if the game is over, it is not this player's turn, or the cell is taken or off the grid
+    word, bit, highest = move_position(index)
+    size, winning_line = game["grid_properties"]["size"], game["grid_properties"]["winning_line"]
+    if game["state"] != "ongoing" or \
+            username != (game["x_player_name"] if game["x_turn"] else game["o_player_name"]) or \
+            size <= highest or (game["x_board"][word] | game["o_board"][word]) >> bit & 1:
+        return None
+
+    board_field = "x_board" if game["x_turn"] else "o_board"
+    board = list(game[board_field])
+    board[word] |= 1 << bit
+    move_count = game["move_count"] + 1
+    with determine_state_seconds.time():
+        state = determine_state(board_from_words(board), size, winning_line, index, game["x_turn"], move_count)
+
+    changes = {
+        board_field: board,
+        "last_move": {"player_name": username, "cell": cell},
+        "x_turn": not game["x_turn"],
+        "move_count": move_count,
+        "state": state
+    }
+    if state != "ongoing":
+        changes["result_recorded"] = False
+    return changes, {"seq": move_count, "player_name": username, "cell": cell}
+
+
+async def apply_move(game_id: str, username: str, cell: str, index: int):
+    # Writes the move together with the state it leads to, in one update conditional on the version
+    # it was checked against, so no other move can land on a game that is already decided. Only that
+    # write's caller counts the result in the players' records. Returns the updated game, or None if
+    # the game is not found, the move isn't allowed, or the game kept changing under the move
+    if GAME_ACTORS:
+        actor = await actor_for(game_id)
+        move = play_move(actor.game, username, cell, index) if actor is not None else None
+        return actor.apply_move(*move) if move is not None else None
+
+    for fresh in (False, True):
+        # a cached game may be behind, so a move it rejects or that loses the write is tried on a fresh read
+        game = await find_game(game_id, fresh=fresh)
+        if game is None:
+            return None
+        move = play_move(game, username, cell, index)
+        if move is None:
+            continue
+
+        changes, entry = move
+        if await store.apply_move(game["_id"], game["version"], changes, entry):
+            game.update(changes)
+            game["version"] += 1
+            game_cache.put(game)
+            if changes["state"] != "ongoing":
+                try:
+                    await count_result(game)
+                except PyMongoError:
+                    # the move stands either way, the archiver counts the result later
+                    pass
+            return game
+        game_cache.invalidate(game_id)
+    return None
+
+
+async def find_moves(game_id: str, since: int):
+    actor = await find_actor(game_id) if GAME_ACTORS else None
+    if actor is not None:
+        # the log is read from the database, so moves still held by the actor are written first
+        await flush()
+    return await store.find_moves(game_id, since)
+
+
+def board_to_rows(x_board: int, o_board: int, size: int):
+    # compact grid encoding, one string per row with '.' for an empty cell
+    row_mask = (1 << size) - 1
+    rows = []
+    for row in range(size):
+        x_bits = format((x_board >> cell_index(row, 0)) & row_mask, f"0{size}b")[::-1]
+        o_bits = format((o_board >> cell_index(row, 0)) & row_mask, f"0{size}b")[::-1]
+        # adding the rows as decimal digit strings gives 1 for X and 2 for O in every column,
+        # there are no carries because a cell is never set on both boards
+        rows.append(str(int(x_bits) + 2 * int(o_bits)).zfill(size).translate(ROW_CHARACTERS))
+    return rows
+
+
+def board_to_grid(x_board: int, o_board: int, size: int):
+    return [['' if cell == '.' else cell for cell in row] for row in board_to_rows(x_board, o_board, size)]
+
+
+def board_to_base64(board: int, size: int):
+    # packs the board densely, cell (row, column) is bit row * size + column, little-endian
+    row_mask = (1 << size) - 1
+    packed = 0
+    for row in range(size):
+        packed |= ((board >> cell_index(row, 0)) & row_mask) << (row * size)
+    return base64.b64encode(packed.to_bytes((size * size + 7) // 8, "little")).decode()
+
+
+def parse_cell(cell: str, size: int):
+    if len(cell) < 2 or not cell[1:].isdecimal():
+        return None
+
     row = ord(cell[0].lower()) - ord('a')
     column = int(cell[1:]) - 1
 
-    if row >= 0 and row < len(grid) and column >= 0 and column < len(grid):
-        if grid[row][column] == '':
-            return True
-    return False
-
-
-def check_if_won(grid: list, winning_line: int, token: str):
-    # check rows
-    for i in range(len(grid)):
-        for j in range(len(grid) - winning_line + 1):
-            win = all(grid[i][j + k] == token for k in range(winning_line))
-            if win:
-                return True
-
-    # check columns
-    for j in range(len(grid)):
-        for i in range(len(grid) - winning_line + 1):
-            win = all(grid[i + k][j] == token for k in range(winning_line))
-            if win:
-                return True
-
-    # check diagonals (top-left to bottom-right)
-    for i in range(len(grid) - winning_line + 1):
-        for j in range(len(grid) - winning_line + 1):
-            win = all(grid[i + k][j + k] == token for k in range(winning_line))
-            if win:
-                return True
-
-    # check diagonals (top-right to bottom-left)
-    for i in range(len(grid) - winning_line + 1):
-        for j in range(winning_line - 1, len(grid)):
-            win = all(grid[i + k][j - k] == token for k in range(winning_line))
-            if win:
-                return True
-
-    # no winning condition met
-    return False
-
-
-def check_if_is_draw(grid: list):
-    for row in grid:
-        if any(cell == '' for cell in row):
-            return False
-    return True
+    if 0 <= row < size and 0 <= column < size:
+        return cell_index(row, column)
+    return None
+
+
+def cell_name(index: int):
+    row, column = divmod(index, MAX_GRID_SIZE)
+    return chr(ord('a') + row) + str(column + 1)
+
+
+def check_if_valid_move(x_board: int, o_board: int, index: int):
+    return index is not None and not (x_board | o_board) >> index & 1
+
+
+def check_if_won(board: int, size: int, winning_line: int):
+    return any(board & mask == mask for mask in winning_masks(size, winning_line))
+
+
+def check_if_won_at(board: int, size: int, winning_line: int, index: int):
+    # only the lines through the last move can have been completed by it
+    return any(board & mask == mask for mask in winning_masks_by_cell(size, winning_line)[index])
+
+
+def determine_state(board: int, size: int, winning_line: int, index: int, x_moved: bool, move_count: int):
+    if check_if_won_at(board, size, winning_line, index):
+        return "won_by_x" if x_moved else "won_by_o"
+    elif move_count == size * size:
+        return "draw"
+    else:
+        return "ongoing"
 
 
-def determine_state(grid: list, winning_line: int):
-    if check_if_won(grid, winning_line, 'X'):
+def determine_state_full_scan(x_board: int, o_board: int, size: int, winning_line: int):
+    if check_if_won(x_board, size, winning_line):
         return "won_by_x"
-    elif check_if_won(grid, winning_line, 'O'):
+    elif check_if_won(o_board, size, winning_line):
         return "won_by_o"
-    elif check_if_is_draw(grid):
+    elif bin(x_board | o_board).count('1') == size * size:
         return "draw"
     else:
         return "ongoing"
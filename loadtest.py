@@ -0,0 +1,206 @@
+import argparse
+import asyncio
+import json
+import os
+import random
+import statistics
+import time
+import uuid
+from collections import defaultdict
+import httpx
+
+PASSWORD = "loadtest-password"
+# the run goes through these one after the other, each timed on its own: creating and logging in users
+# is bound by password hashing, which would otherwise swamp the game requests
+PHASES = ("setup", "games", "teardown")
+
+
+class Recorder:
+    def __init__(self):
+        self.phase = PHASES[0]
+        self.elapsed = {}
+        self.latencies = {phase: defaultdict(list) for phase in PHASES}
+        self.rejected = {phase: defaultdict(int) for phase in PHASES}
+        self.games = 0
+        self.moves = 0
+
+    async def run_phase(self, phase: str, calls: list):
+        self.phase = phase
+        started = time.perf_counter()
+        results = await asyncio.gather(*calls)
+        self.elapsed[phase] = time.perf_counter() - started
+        return results
+
+    async def call(self, client: httpx.AsyncClient, method: str, path: str, **kwargs):
+        while True:
+            started = time.perf_counter()
+            response = await client.request(method, path, **kwargs)
+            self.latencies[self.phase][path].append(time.perf_counter() - started)
+            if response.status_code == 503 and "Retry-After" in response.headers:
+                # the password hash queue is full, back off like a client would
+                self.rejected[self.phase][path] += 1
+                await asyncio.sleep(float(response.headers["Retry-After"]))
+                continue
+            if response.status_code != 200:
+                raise RuntimeError(f"{method} {path} returned {response.status_code}: {response.text}")
+            return response.json()
+
+
+def percentile(sorted_latencies: list, fraction: float):
+    return sorted_latencies[min(len(sorted_latencies) - 1, int(len(sorted_latencies) * fraction))]
+
+
+def cell_name(row: int, column: int):
+    return chr(ord('a') + row) + str(column + 1)
+
+
+async def create_player(client: httpx.AsyncClient, recorder: Recorder, username: str):
+    await recorder.call(client, "POST", "/create_user", auth=(username, PASSWORD))
+    token = (await recorder.call(client, "POST", "/login", auth=(username, PASSWORD)))["token"]
+    return {"Authorization": f"Bearer {token}"}
+
+
+async def play_game(client: httpx.AsyncClient, recorder: Recorder, game_id: str, players: dict, size: int, rng):
+    x_turn = True
+    cells = [cell_name(row, column) for row in range(size) for column in range(size)]
+    rng.shuffle(cells)
+    for cell in cells:
+        headers = players["x" if x_turn else "o"]
+        await recorder.call(client, "GET", "/poll_game", params={"game_id": game_id}, headers=headers)
+        result = await recorder.call(client, "POST", "/make_move", json={"game_id": game_id, "cell": cell},
+                                     headers=headers)
+        recorder.moves += 1
+        x_turn = not x_turn
+        if result["game_state"] != "ongoing":
+            break
+    recorder.games += 1
+
+
+async def set_up_pair(client: httpx.AsyncClient, recorder: Recorder, names: tuple, args):
+    players = {"x": await create_player(client, recorder, names[0]),
+               "o": await create_player(client, recorder, names[1])}
+
+    await recorder.call(client, "POST", "/start_waiting", headers=players["o"])
+    invitation = {"invited": names[1], "grid_properties": {"size": args.size, "winning_line": args.winning_line},
+                  "inviter_playing_x": True, "play_again_scheme": "alternating"}
+    invitation_id = (await recorder.call(client, "POST", "/invite", json=invitation,
+                                         headers=players["x"]))["invitation_id"]
+    await recorder.call(client, "GET", "/poll_invitations", headers=players["o"])
+    game_id = (await recorder.call(client, "POST", "/respond_invitation",
+                                   json={"invitation_id": invitation_id, "response": "accept"},
+                                   headers=players["o"]))["game_id"]
+    return players, game_id
+
+
+async def play_games(client: httpx.AsyncClient, recorder: Recorder, players: dict, game_id: str, args, rng):
+    for game in range(args.games):
+        await play_game(client, recorder, game_id, players, args.size, rng)
+        if game == args.games - 1:
+            break
+
+        await recorder.call(client, "POST", "/play_again", json={"game_id": game_id, "play_again": True},
+                            headers=players["x"])
+        result = await recorder.call(client, "POST", "/play_again", json={"game_id": game_id, "play_again": True},
+                                     headers=players["o"])
+        game_id = result["new_game_id"]
+        if result["switch_sides"]:
+            players = {"x": players["o"], "o": players["x"]}
+
+
+async def tear_down_pair(client: httpx.AsyncClient, recorder: Recorder, names: tuple):
+    for name in names:
+        await recorder.call(client, "DELETE", "/delete_account", auth=(name, PASSWORD))
+
+
+def report_phase(recorder: Recorder, phase: str):
+    elapsed = recorder.elapsed[phase]
+    requests = sum(len(latencies) for latencies in recorder.latencies[phase].values())
+    results = {
+        "elapsed_seconds": elapsed,
+        "requests": requests,
+        "requests_per_second": requests / elapsed,
+        "endpoints": {}
+    }
+
+    print(f"{phase}: {requests} requests in {elapsed:.2f}s ({requests / elapsed:.0f} requests/s)")
+    print(f"{'endpoint':<22} {'requests':>9} {'req/s':>8} {'mean ms':>8} {'p50 ms':>8} {'p95 ms':>8} {'p99 ms':>8}"
+          f" {'503s':>5}")
+    for path, latencies in sorted(recorder.latencies[phase].items()):
+        latencies = sorted(latencies)
+        endpoint = {
+            "requests": len(latencies),
+            "requests_per_second": len(latencies) / elapsed,
+            "mean_ms": statistics.fmean(latencies) * 1e3,
+            "p50_ms": percentile(latencies, 0.50) * 1e3,
+            "p95_ms": percentile(latencies, 0.95) * 1e3,
+            "p99_ms": percentile(latencies, 0.99) * 1e3,
+            "rejected": recorder.rejected[phase][path]
+        }
+        results["endpoints"][path] = endpoint
+        print(f"{path:<22} {endpoint['requests']:>9} {endpoint['requests_per_second']:>8.0f}"
+              f" {endpoint['mean_ms']:>8.2f} {endpoint['p50_ms']:>8.2f} {endpoint['p95_ms']:>8.2f}"
+              f" {endpoint['p99_ms']:>8.2f} {endpoint['rejected']:>5}")
+    return results
+
+
+def report(recorder: Recorder):
+    # moves only happen in the games phase, so that is the time they are measured over
+    games_elapsed = recorder.elapsed["games"]
+    results = {
+        "elapsed_seconds": sum(recorder.elapsed.values()),
+        "games": recorder.games,
+        "moves": recorder.moves,
+        "moves_per_second": recorder.moves / games_elapsed,
+        "phases": {}
+    }
+
+    print(f"{recorder.games} games, {recorder.moves} moves in {games_elapsed:.2f}s"
+          f" ({recorder.moves / games_elapsed:.0f} moves/s), {results['elapsed_seconds']:.2f}s in all")
+    for phase in PHASES:
+        print()
+        results["phases"][phase] = report_phase(recorder, phase)
+    return results
+
+
+async def run(args):
+    # the storage backend and the move path are picked when the app is imported
+    os.environ["STORAGE_BACKEND"] = args.storage
+    os.environ["GAME_ACTORS"] = "1" if args.actors else "0"
+    import main
+
+    recorder = Recorder()
+    # usernames are unique per run, so runs against a persistent database don't collide
+    run_id = uuid.uuid4().hex[:8]
+    pairs = [(f"{run_id}x{pair}", f"{run_id}o{pair}") for pair in range(args.players // 2)]
+
+    async with main.lifespan(main.app):
+        transport = httpx.ASGITransport(app=main.app)
+        async with httpx.AsyncClient(transport=transport, base_url="http://loadtest") as client:
+            pair_games = await recorder.run_phase("setup", [set_up_pair(client, recorder, names, args)
+                                                            for names in pairs])
+            await recorder.run_phase("games", [play_games(client, recorder, players, game_id, args,
+                                                          random.Random(f"{args.seed}-{pair}"))
+                                               for pair, (players, game_id) in enumerate(pair_games)])
+            await recorder.run_phase("teardown", [tear_down_pair(client, recorder, names) for names in pairs])
+
+    return report(recorder)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Plays full games through the app in-process and reports latencies")
+    parser.add_argument("--players", type=int, default=20, help="concurrent players, paired up into games")
+    parser.add_argument("--games", type=int, default=3, help="games each pair plays, using play again")
+    parser.add_argument("--size", type=int, default=10)
+    parser.add_argument("--winning-line", type=int, default=5)
+    parser.add_argument("--seed", default="0", help="seeds the moves, so runs play the same games")
+    parser.add_argument("--storage", choices=("memory", "mongo"), default="memory",
+                        help="memory needs no database, mongo uses the one configured in the environment")
+    parser.add_argument("--actors", action="store_true",
+                        help="apply moves through per-game actors with batched writes instead of one write per move")
+    parser.add_argument("--output", help="also write the results as JSON to this file")
+    args = parser.parse_args()
+
+    results = asyncio.run(run(args))
+    if args.output:
+        with open(args.output, "w") as output:
+            json.dump({"arguments": vars(args), **results}, output, indent=2)
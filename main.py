@@ -1,37 +1,129 @@
-from fastapi import FastAPI, HTTPException, Depends, Header
-from fastapi.security import HTTPBasic, HTTPBasicCredentials, OAuth2PasswordBearer
-from fastapi.responses import JSONResponse
-from argon2 import PasswordHasher
+from fastapi import FastAPI, HTTPException, Depends, Header, Query, Request, WebSocket, WebSocketDisconnect, status
+from fastapi.security import HTTPBasic, HTTPBasicCredentials
+from fastapi.responses import ORJSONResponse, Response, StreamingResponse
 from argon2.exceptions import Argon2Error
+from prometheus_client import Counter, Histogram, generate_latest, CONTENT_TYPE_LATEST
+from starlette.routing import Match
 import jwt
-import secrets
+import os
+import io
+import csv
+import orjson
 import re
-from schemas import NewMove, Invitation, InvitationResponse, PlayAgain
-from database import users, waiting_users, invitations, games, handle_db_exception
+import time
+import uuid
+import asyncio
+import hashlib
+import logging
+from contextlib import asynccontextmanager
+from auth import generate_token, decode_token, verify_token
+from schemas import (NewMove, Invitation, InvitationResponse, PlayAgain, PollGames, GridProperties,
+                     MatchmakingRequest)
+from database import handle_db_exception
+from storage import store
 from pymongo.errors import PyMongoError, DuplicateKeyError
 from bson import ObjectId
-from game import create_game, check_if_valid_move, determine_state
-
-app = FastAPI()
+from cache import game_cache
+from events import (MAX_WAIT_SECONDS, subscribe, publish, start_events, stop_events, game_channel, invitations_channel,
+                    invitation_channel, matchmaking_channel)
+from matchmaking import take_ticket, claim_partner, enter_queue
+from passwords import hash_password, verify_password, close_pool
+from archive import start_archiver, stop_archiver
+from actors import start_actors, stop_actors
+from bitboard import MAX_GRID_SIZE, board_from_words
+from game import (create_game, find_game, find_games, update_game, apply_move, find_moves, parse_cell, cell_name,
+                  check_if_valid_move, board_to_grid, board_to_rows, board_to_base64)
+from bot import (BOT_USERNAME, BOT_MOVE_ATTEMPTS, BOT_RETRY_SECONDS, choose_move, start_bot_pool,
+                 close_bot_pool)
+import spectators
+
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    await store.start()
+    await start_events()
+    await start_archiver(schedule_bot_move)
+    await start_actors()
+    await start_bot_pool()
+    yield
+    await stop_archiver()
+    # moves still held by game actors are written before the database connection closes
+    await stop_actors()
+    await stop_events()
+    await store.stop()
+    close_pool()
+    close_bot_pool()
+
+
+app = FastAPI(lifespan=lifespan, default_response_class=ORJSONResponse)
+DEFAULT_PAGE_SIZE = 50
+MAX_PAGE_SIZE = 100
+# Retry-After hints on poll responses: how soon something may change, and how soon when it is the
+# player's own move to make or the game is over
+POLL_RETRY_AFTER_SECONDS = int(os.getenv("POLL_RETRY_AFTER_SECONDS", "1"))
+IDLE_POLL_RETRY_AFTER_SECONDS = int(os.getenv("IDLE_POLL_RETRY_AFTER_SECONDS", "5"))
+# a trace id from this request header is echoed back, otherwise one is generated; empty turns trace ids off
+REQUEST_ID_HEADER = os.getenv("REQUEST_ID_HEADER", "X-Request-ID")
 security = HTTPBasic()
-oauth2_scheme = OAuth2PasswordBearer(tokenUrl="token")
-ph = PasswordHasher()
-secret_key = secrets.token_hex(256)
+# the task making the bot's move in each game, and the games it should look at again when done
+bot_tasks = {}
+bot_wakeups = set()
+logger = logging.getLogger(__name__)
 
+request_seconds = Histogram("http_request_duration_seconds", "Time to respond to a request", ["method", "route"])
+responses = Counter("http_responses_total", "Responses sent", ["method", "route", "status"])
 
-def generate_token(username):
-    token = jwt.encode({'user': username}, secret_key, algorithm='HS256')
-    return token
 
+def route_template(request: Request):
+    # label requests by route template, so every game id doesn't become its own time series
+    for route in request.app.routes:
+        match, _ = route.matches(request.scope)
+        if match == Match.FULL:
+            return route.path
+    return "unmatched"
+
+
+@app.middleware("http")
+async def instrument(request: Request, call_next):
+    started = time.perf_counter()
+    response = await call_next(request)
+    route = route_template(request)
+    request_seconds.labels(request.method, route).observe(time.perf_counter() - started)
+    responses.labels(request.method, route, str(response.status_code)).inc()
+    if REQUEST_ID_HEADER:
+        response.headers[REQUEST_ID_HEADER] = request.headers.get(REQUEST_ID_HEADER) or uuid.uuid4().hex
+    return response
+
+
+def next_page(items: list, limit: int, id_field: str):
+    return items[-1][id_field] if len(items) == limit else None
+
+
+def make_etag(*parts):
+    return '"' + "-".join(str(part) for part in parts) + '"'
+
+
+def etag_matches(etag: str, if_none_match: str):
+    return if_none_match is not None and \
+        any(tag.strip() in (etag, "W/" + etag, "*") for tag in if_none_match.split(","))
 
-def verify_token(token: str = Depends(oauth2_scheme)):
-    try:
-        payload = jwt.decode(token, secret_key, algorithms=['HS256'])
-        return payload['user']
-    except jwt.ExpiredSignatureError:
-        raise HTTPException(status_code=400, detail="Signature has expired")
-    except jwt.InvalidTokenError:
-        raise HTTPException(status_code=400, detail="Invalid token")
+
+def not_modified(etag: str, retry_after: int):
+    return Response(status_code=304, headers={"ETag": etag, "Retry-After": str(retry_after)})
+
+
+def set_poll_headers(response: Response, etag: str, retry_after: int):
+    response.headers["ETag"] = etag
+    response.headers["Retry-After"] = str(retry_after)
+
+
+def validate_game_settings(grid_properties: GridProperties, play_again_scheme: str):
+    if grid_properties.size < 3 or grid_properties.size > 26 or \
+            grid_properties.winning_line > grid_properties.size:
+        raise HTTPException(status_code=400, detail="Grid properties not allowed")
+
+    if play_again_scheme not in {"same", "alternating", "winner_plays_x", "winner_plays_o"}:
+        raise HTTPException(status_code=400, detail="Unknown play again scheme")
 
 
 def validate_username(username: str):
@@ -55,6 +147,11 @@ async def check_availability():
     return {"message": "Tic-tac-toe server is available here"}
 
 
+@app.get("/metrics")
+async def metrics():
+    return Response(content=generate_latest(), media_type=CONTENT_TYPE_LATEST)
+
+
 @app.post("/create_user")
 async def create_user(credentials: HTTPBasicCredentials = Depends(security)):
     try:
@@ -62,7 +159,9 @@ async def create_user(credentials: HTTPBasicCredentials = Depends(security)):
         password = credentials.password
         validate_username(username)
         validate_password(password)
-        hashed_password = ph.hash(password)
+        if username == BOT_USERNAME:
+            raise HTTPException(status_code=400, detail="This username is taken")
+        hashed_password = await hash_password(password)
 
         new_user = {
             "username": username,
@@ -70,7 +169,7 @@ async def create_user(credentials: HTTPBasicCredentials = Depends(security)):
         }
 
         try:
-            users.insert_one(new_user)
+            await store.insert_user(new_user)
         except DuplicateKeyError:
             raise HTTPException(status_code=400, detail="This username is taken")
         except PyMongoError as e:
@@ -89,7 +188,7 @@ async def login(credentials: HTTPBasicCredentials = Depends(security)):
         password = credentials.password
 
         try:
-            user = users.find_one({"username": username})
+            user = await store.find_user(username)
         except PyMongoError as e:
             handle_db_exception(e)
 
@@ -97,7 +196,7 @@ async def login(credentials: HTTPBasicCredentials = Depends(security)):
             raise HTTPException(status_code=400, detail="Username does not exist")
 
         try:
-            if ph.verify(user["hashed_password"], password):
+            if await verify_password(user["hashed_password"], password):
                 token = generate_token(username)
                 return {"status": "Logged in", "token": token}
             else:
@@ -115,7 +214,7 @@ async def delete_account(credentials: HTTPBasicCredentials = Depends(security)):
         password = credentials.password
 
         try:
-            user = users.find_one({"username": username})
+            user = await store.find_user(username)
         except PyMongoError as e:
             handle_db_exception(e)
 
@@ -123,9 +222,9 @@ async def delete_account(credentials: HTTPBasicCredentials = Depends(security)):
             raise HTTPException(status_code=400, detail="Username does not exist")
 
         try:
-            if ph.verify(user["hashed_password"], password):
+            if await verify_password(user["hashed_password"], password):
                 try:
-                    users.delete_one({"username": username})
+                    await store.delete_user(username)
                     return {"status": "Account deleted"}
                 except PyMongoError as e:
                     handle_db_exception(e)
@@ -140,7 +239,7 @@ async def delete_account(credentials: HTTPBasicCredentials = Depends(security)):
 @app.post("/start_waiting")
 async def start_waiting(username: str = Depends(verify_token)):
     try:
-        waiting_users.insert_one({"username": username})
+        await store.add_waiting_user(username)
         return {"status": "Waiting for game"}
     except PyMongoError as e:
         handle_db_exception(e)
@@ -149,17 +248,57 @@ async def start_waiting(username: str = Depends(verify_token)):
 @app.post("/stop_waiting")
 async def stop_waiting(username: str = Depends(verify_token)):
     try:
-        waiting_users.delete_one({"username": username})
+        await store.remove_waiting_user(username)
         return {"status": "Stopped waiting"}
     except PyMongoError as e:
         handle_db_exception(e)
 
 
 @app.get("/waiting_users")
-async def get_waiting_users(username: str = Depends(verify_token)):
+async def get_waiting_users(limit: int = Query(DEFAULT_PAGE_SIZE, ge=1, le=MAX_PAGE_SIZE), after: str = None,
+                            username: str = Depends(verify_token)):
     try:
-        result = waiting_users.find({}, {"_id": 0, "username": 1})
-        return {"waiting_users": {user["username"] for user in result} - {username}}
+        waiting_list = await store.find_waiting_users(limit, after)
+        return {
+            "waiting_users": [user["username"] for user in waiting_list if user["username"] != username],
+            "next_after": str(waiting_list[-1]["_id"]) if len(waiting_list) == limit else None
+        }
+    except PyMongoError as e:
+        handle_db_exception(e)
+
+
+def matched(ticket: dict):
+    # whoever was claimed from the queue waited longer and plays X
+    return {"status": "matched", "game_id": ticket["matched_game_id"], "you_playing_x": True}
+
+
+@app.post("/matchmake")
+async def matchmake(request_body: MatchmakingRequest, wait: float = 0, username: str = Depends(verify_token)):
+    try:
+        validate_game_settings(request_body.grid_properties, request_body.play_again_scheme)
+        size = request_body.grid_properties.size
+        winning_line = request_body.grid_properties.winning_line
+
+        with subscribe(matchmaking_channel(username)) as subscription:
+            ticket = await take_ticket(username)
+            if ticket is not None and ticket["matched_game_id"] is not None:
+                return matched(ticket)
+
+            partner = await claim_partner(username, size, winning_line, request_body.play_again_scheme)
+            if partner is not None:
+                await publish(matchmaking_channel(partner["username"]),
+                              {"event": "matched", "game_id": partner["matched_game_id"]})
+                return {"status": "matched", "game_id": partner["matched_game_id"], "you_playing_x": False}
+
+            await enter_queue(username, size, winning_line, request_body.play_again_scheme)
+            if wait > 0 and await subscription.wait(min(wait, MAX_WAIT_SECONDS)) is not None:
+                ticket = await take_ticket(username)
+                if ticket is not None and ticket["matched_game_id"] is not None:
+                    return matched(ticket)
+                elif ticket is not None:
+                    await enter_queue(username, size, winning_line, request_body.play_again_scheme)
+
+        return {"status": "waiting"}
     except PyMongoError as e:
         handle_db_exception(e)
 
@@ -167,18 +306,13 @@ async def get_waiting_users(username: str = Depends(verify_token)):
 @app.post("/invite")
 async def invite_user(request_body: Invitation, inviter: str = Depends(verify_token)):
     try:
-        if waiting_users.find_one({"username": request_body.invited}) is None:
+        if request_body.invited != BOT_USERNAME and not await store.is_waiting(request_body.invited):
             raise HTTPException(status_code=400, detail="Invited user is not waiting for a game")
 
         if request_body.invited == inviter:
             raise HTTPException(status_code=400, detail="You cannot invite yourself")
 
-        if request_body.grid_properties.size < 3 or request_body.grid_properties.size > 26 or \
-                request_body.grid_properties.winning_line > request_body.grid_properties.size:
-            raise HTTPException(status_code=400, detail="Grid properties not allowed")
-
-        if request_body.play_again_scheme not in {"same", "alternating", "winner_plays_x", "winner_plays_o"}:
-            raise HTTPException(status_code=400, detail="Unknown play again scheme")
+        validate_game_settings(request_body.grid_properties, request_body.play_again_scheme)
 
         new_invitation = {
             "inviter": inviter,
@@ -189,45 +323,88 @@ async def invite_user(request_body: Invitation, inviter: str = Depends(verify_to
             },
             "inviter_playing_x": request_body.inviter_playing_x,
             "play_again_scheme": request_body.play_again_scheme,
+            "public": request_body.public,
             "status": "pending",
-            "game_id": None
+            "game_id": None,
+            "version": 0
         }
 
-        invitation_id = str(invitations.insert_one(new_invitation).inserted_id)
+        invitation_id = await store.insert_invitation(new_invitation)
+        if request_body.invited == BOT_USERNAME:
+            # the computer accepts every invitation straight away
+            game_id = await create_game(inviter if request_body.inviter_playing_x else BOT_USERNAME,
+                                        BOT_USERNAME if request_body.inviter_playing_x else inviter,
+                                        request_body.grid_properties.size, request_body.grid_properties.winning_line,
+                                        request_body.play_again_scheme, public=request_body.public)
+            await store.update_invitation(invitation_id, {"status": "accepted", "game_id": game_id})
+            schedule_bot_move(await find_game(game_id))
+            return {"invitation_id": invitation_id, "game_id": game_id}
+
+        await publish(invitations_channel(request_body.invited), {"event": "invited", "invitation_id": invitation_id})
         return {"invitation_id": invitation_id}
     except PyMongoError as e:
         handle_db_exception(e)
 
 
+async def find_pending_invitations(username: str, limit: int, after: str):
+    invitations_list = []
+    versions = []
+    for invitation in await store.find_received_invitations(username, limit, after):
+        invitation_details = {
+            "invitation_id": str(invitation["_id"]),
+            "inviter": invitation["inviter"],
+            "grid_properties": invitation["grid_properties"],
+            "inviter_playing_x": invitation["inviter_playing_x"],
+            "play_again_scheme": invitation["play_again_scheme"]
+        }
+        invitations_list.append(invitation_details)
+        # invitations stored before they were versioned count as version 0
+        versions.append(f'{invitation["_id"]}.{invitation.get("version", 0)}')
+    etag = make_etag(hashlib.sha1(",".join(versions).encode()).hexdigest())
+    return invitations_list, etag
+
+
 @app.get("/poll_invitations")
-async def poll_invitations(username: str = Depends(verify_token)):
+async def poll_invitations(response: Response, wait: float = 0,
+                           limit: int = Query(DEFAULT_PAGE_SIZE, ge=1, le=MAX_PAGE_SIZE), after: str = None,
+                           if_none_match: str = Header(None), username: str = Depends(verify_token)):
     try:
-        result = invitations.find({"invited": username, "status": "pending"})
-        invitations_list = []
-        for invitation in result:
-            invitation_details = {
-                "invitation_id": str(invitation["_id"]),
-                "inviter": invitation["inviter"],
-                "grid_properties": invitation["grid_properties"],
-                "inviter_playing_x": invitation["inviter_playing_x"],
-                "play_again_scheme": invitation["play_again_scheme"]
-            }
-            invitations_list.append(invitation_details)
-        return {"invitations": invitations_list}
+        with subscribe(invitations_channel(username)) as subscription:
+            invitations_list, etag = await find_pending_invitations(username, limit, after)
+            if wait > 0 and (not invitations_list or etag_matches(etag, if_none_match)):
+                if await subscription.wait(min(wait, MAX_WAIT_SECONDS)) is not None:
+                    invitations_list, etag = await find_pending_invitations(username, limit, after)
+
+        if etag_matches(etag, if_none_match):
+            return not_modified(etag, POLL_RETRY_AFTER_SECONDS)
+        set_poll_headers(response, etag, POLL_RETRY_AFTER_SECONDS)
+        return {"invitations": invitations_list, "next_after": next_page(invitations_list, limit, "invitation_id")}
     except PyMongoError as e:
         handle_db_exception(e)
 
 
 @app.get("/poll_invitation_status")
-async def poll_invitation_status(invitation_id: str, username: str = Depends(verify_token)):
+async def poll_invitation_status(invitation_id: str, response: Response, wait: float = 0,
+                                 if_none_match: str = Header(None), username: str = Depends(verify_token)):
     try:
-        invitation = invitations.find_one({"_id": ObjectId(invitation_id)})
-        if invitation is None:
-            raise HTTPException(status_code=404, detail="Invitation not found")
-        if invitation["inviter"] != username:
-            raise HTTPException(status_code=403, detail="This invitation is not yours")
+        with subscribe(invitation_channel(invitation_id)) as subscription:
+            invitation = await store.find_invitation_status(invitation_id)
+            if invitation is None:
+                raise HTTPException(status_code=404, detail="Invitation not found")
+            if invitation["inviter"] != username:
+                raise HTTPException(status_code=403, detail="This invitation is not yours")
+
+            if invitation["status"] == "pending" and wait > 0:
+                if await subscription.wait(min(wait, MAX_WAIT_SECONDS)) is not None:
+                    invitation = await store.find_invitation_status(invitation_id)
 
         status = invitation["status"]
+        etag = make_etag(invitation.get("version", 0))
+        retry_after = POLL_RETRY_AFTER_SECONDS if status == "pending" else IDLE_POLL_RETRY_AFTER_SECONDS
+        if etag_matches(etag, if_none_match):
+            return not_modified(etag, retry_after)
+        set_poll_headers(response, etag, retry_after)
+
         if status == "accepted":
             return {"status": status, "game_id": invitation["game_id"]}
         else:
@@ -240,46 +417,44 @@ async def poll_invitation_status(invitation_id: str, username: str = Depends(ver
 async def respond_invitation(request_body: InvitationResponse, username: str = Depends(verify_token)):
     try:
         invitation_id = request_body.invitation_id
-        response = request_body.response
+        response = request_body.response.lower()
+        if response not in ("accept", "decline"):
+            raise HTTPException(status_code=400, detail="Invalid response")
 
-        invitation = invitations.find_one({"_id": ObjectId(invitation_id)})
+        # only the invited player can end a pending invitation, and only one response wins
+        if response == "accept":
+            game_id = ObjectId()
+            async with store.transaction():
+                invitation = await store.update_invitation(invitation_id,
+                                                           {"status": "accepted", "game_id": str(game_id)},
+                                                           {"invited": username, "status": "pending"})
+                if invitation is not None:
+                    players = (invitation["inviter"], invitation["invited"])
+                    x_player, o_player = players if invitation["inviter_playing_x"] else reversed(players)
+                    await create_game(x_player, o_player, invitation["grid_properties"]["size"],
+                                      invitation["grid_properties"]["winning_line"], invitation["play_again_scheme"],
+                                      game_id=game_id, public=invitation.get("public", False))
+                    await store.remove_waiting_users(list(players))
+
+            if invitation is not None:
+                await publish(invitation_channel(invitation_id), {"event": "accepted", "game_id": str(game_id)})
+                return {"game_id": str(game_id)}
+        else:
+            invitation = await store.update_invitation(invitation_id, {"status": "declined"},
+                                                       {"invited": username, "status": "pending"})
+            if invitation is not None:
+                await publish(invitation_channel(invitation_id), {"event": "declined"})
+                return {"detail": "Invitation declined"}
+
+        invitation = await store.find_invitation(invitation_id)
         if invitation is None:
             raise HTTPException(status_code=404, detail="Invitation not found")
-
-        if response.lower() == "accept":
-            if invitation and invitation["invited"] == username and invitation["status"] == "pending":
-                size = invitation["grid_properties"]["size"]
-                winning_line = invitation["grid_properties"]["winning_line"]
-
-                if invitation["inviter_playing_x"]:
-                    game_id = create_game(invitation["inviter"], invitation["invited"],
-                                          size, winning_line, invitation["play_again_scheme"])
-                else:
-                    game_id = create_game(invitation["invited"], invitation["inviter"],
-                                          size, winning_line, invitation["play_again_scheme"])
-
-                waiting_users.delete_one({"username": invitation["inviter"]})
-                waiting_users.delete_one({"username": invitation["invited"]})
-
-                invitations.update_one({"_id": ObjectId(invitation_id)},
-                                       {"$set": {"status": "accepted", "game_id": game_id}})
-
-                return {"game_id": game_id}
-
-            elif invitation is None:
-                raise HTTPException(status_code=404, detail="Invitation not found")
-            elif invitation["invited"] != username:
-                raise HTTPException(status_code=403, detail="This invitation is not for you")
-            elif invitation["status"] == "cancelled":
-                raise HTTPException(status_code=410, detail="Invitation cancelled by inviter")
-            elif invitation["status"] != "pending":
-                raise HTTPException(status_code=409, detail="Invitation already responded to")
-
-        elif response.lower() == "decline":
-            invitations.update_one({"_id": ObjectId(invitation_id)}, {"$set": {"status": "declined"}})
-            return {"detail": "Invitation declined"}
+        elif invitation["invited"] != username:
+            raise HTTPException(status_code=403, detail="This invitation is not for you")
+        elif invitation["status"] == "cancelled":
+            raise HTTPException(status_code=410, detail="Invitation cancelled by inviter")
         else:
-            raise HTTPException(status_code=400, detail="Invalid response")
+            raise HTTPException(status_code=409, detail="Invitation already responded to")
     except PyMongoError as e:
         handle_db_exception(e)
 
@@ -287,18 +462,34 @@ async def respond_invitation(request_body: InvitationResponse, username: str = D
 @app.post("/cancel_invitation")
 async def cancel_invitation(invitation_id: str, username: str = Depends(verify_token)):
     try:
-        invitations.update_one({"_id": ObjectId(invitation_id)}, {"$set": {"status": "cancelled"}})
-        return {"detail": "Invitation cancelled"}
+        invitation = await store.update_invitation(invitation_id, {"status": "cancelled"},
+                                                   {"inviter": username, "status": "pending"})
+        if invitation is not None:
+            await publish(invitation_channel(invitation_id), {"event": "cancelled"})
+            await publish(invitations_channel(invitation["invited"]),
+                          {"event": "cancelled", "invitation_id": invitation_id})
+            return {"detail": "Invitation cancelled"}
+
+        invitation = await store.find_invitation(invitation_id)
+        if invitation is None:
+            raise HTTPException(status_code=404, detail="Invitation not found")
+        elif invitation["inviter"] != username:
+            raise HTTPException(status_code=403, detail="This invitation is not yours")
+        elif invitation["status"] == "cancelled":
+            # cancelling again changes nothing
+            return {"detail": "Invitation cancelled"}
+        else:
+            raise HTTPException(status_code=409, detail=f"Invitation already {invitation['status']}")
     except PyMongoError as e:
         handle_db_exception(e)
 
 
 @app.get("/get_sent_invitations")
-async def get_sent_invitations(username: str = Depends(verify_token)):
+async def get_sent_invitations(limit: int = Query(DEFAULT_PAGE_SIZE, ge=1, le=MAX_PAGE_SIZE), after: str = None,
+                               username: str = Depends(verify_token)):
     try:
-        result = invitations.find({"invited": username, "status": "pending"})
         invitations_list = []
-        for invitation in result:
+        for invitation in await store.find_sent_invitations(username, limit, after):
             invitation_details = {
                 "invitation_id": str(invitation["_id"]),
                 "invited": invitation["invited"],
@@ -309,7 +500,7 @@ async def get_sent_invitations(username: str = Depends(verify_token)):
                 "game_id": invitation["game_id"]
             }
             invitations_list.append(invitation_details)
-        return {"invitations": invitations_list}
+        return {"invitations": invitations_list, "next_after": next_page(invitations_list, limit, "invitation_id")}
     except PyMongoError as e:
         handle_db_exception(e)
 
@@ -320,70 +511,137 @@ async def make_move(new_move: NewMove, username: str = Depends(verify_token)):
         game_id = new_move.game_id
         cell = new_move.cell
 
-        game = games.find_one({"_id": ObjectId(game_id)})
+        index = parse_cell(cell, MAX_GRID_SIZE)
+        game = await apply_move(game_id, username, cell, index) if index is not None else None
+
         if game is None:
-            raise HTTPException(status_code=404, detail="Game not found")
+            # the move was rejected, read the game once to tell the player why
+            game = await find_game(game_id, fresh=True)
+            if game is None:
+                raise HTTPException(status_code=404, detail="Game not found")
+
+            if username != game["x_player_name"] and username != game["o_player_name"]:
+                raise HTTPException(status_code=403, detail="You are not a player in this game")
+
+            try:
+                if not game["state"] == "ongoing":
+                    raise ValueError("Game is finished")
+                elif (game["x_turn"] and username != game["x_player_name"]) or \
+                        (not game["x_turn"] and username != game["o_player_name"]):
+                    if game["last_move"] and game["last_move"]["player_name"] == username:
+                        # a concurrent request by this player took the turn first
+                        raise HTTPException(status_code=409, detail="Another move was made first")
+                    raise ValueError("It's not your turn!")
+                elif not check_if_valid_move(board_from_words(game["x_board"]), board_from_words(game["o_board"]),
+                                             parse_cell(cell, game["grid_properties"]["size"])):
+                    raise ValueError("Invalid move!")
+            except ValueError as e:
+                raise HTTPException(status_code=400, detail=str(e))
+
+            raise HTTPException(status_code=409, detail="Game changed during the move, try again")
+
+        new_state = await complete_move(game_id, game, username, cell)
+        schedule_bot_move(game)
+        return {"game_state": new_state}
+    except PyMongoError as e:
+        handle_db_exception(e)
 
-        if username != game["x_player_name"] and username != game["o_player_name"]:
-            raise HTTPException(status_code=403, detail="You are not a player in this game")
 
-        try:
-            if username not in [game["x_player_name"], game["o_player_name"]]:
-                raise ValueError("Player does not exist in this game!")
-            elif not game["state"] == "ongoing":
-                raise ValueError("Game is finished")
-            elif (game["x_turn"] and username != game["x_player_name"]) or \
-                    (not game["x_turn"] and username != game["o_player_name"]):
-                raise ValueError("It's not your turn!")
-            elif not check_if_valid_move(game["grid_state"], cell):
-                raise ValueError("Invalid move!")
+async def complete_move(game_id: str, game: dict, username: str, cell: str):
+    # game is the game with the move applied, in the state the move was written with; tells subscribers
+    new_state = game["state"]
+    await publish(game_channel(game_id), {
+        "event": "move",
+        "player_name": username,
+        "cell": cell,
+        "move_count": game["move_count"],
+        "game_state": new_state
+    })
+    if new_state != "ongoing":
+        await publish(game_channel(game_id), {"event": "state_change", "game_state": new_state})
+    return new_state
 
-            else:
-                token = 'X' if game["x_turn"] else 'O'
-                row = ord(cell[0].lower()) - ord('a')
-                column = int(cell[1:]) - 1
-
-                grid = game["grid_state"]
-                grid[row][column] = token
-                new_state = determine_state(grid, game["grid_properties"]["winning_line"])
-
-                if new_state == game["state"]:
-                    update = {
-                        "$set": {
-                            "grid_state": grid,
-                            "last_move": {"player_name": username, "cell": cell},
-                            "x_turn": not game["x_turn"]
-                        }
-                    }
-                else:
-                    update = {
-                        "$set": {
-                            "grid_state": grid,
-                            "last_move": {"player_name": username, "cell": cell},
-                            "x_turn": not game["x_turn"],
-                            "state": new_state
-                        }
-                    }
 
-                games.update_one({"_id": ObjectId(game_id)}, update)
+def bot_to_move(game: dict):
+    return game is not None and game["state"] == "ongoing" and \
+        (game["x_player_name"] if game["x_turn"] else game["o_player_name"]) == BOT_USERNAME
 
-        except ValueError as e:
-            raise HTTPException(status_code=400, detail=str(e))
 
-        return {"game_state": new_state}
-    except PyMongoError as e:
-        handle_db_exception(e)
+async def play_bot_move(game_id: str):
+    # keeps going while someone asked for a move since the last look at the game, so a player's move
+    # that comes in while this task is finishing up isn't missed
+    try:
+        while True:
+            bot_wakeups.discard(game_id)
+            await make_bot_move(game_id)
+            if game_id not in bot_wakeups:
+                return
+    finally:
+        del bot_tasks[game_id]
+
+
+async def make_bot_move(game_id: str):
+    failures = 0
+    while failures < BOT_MOVE_ATTEMPTS:
+        try:
+            game = await find_game(game_id, fresh=True)
+            if not bot_to_move(game):
+                return
+
+            size = game["grid_properties"]["size"]
+            last_index = parse_cell(game["last_move"]["cell"], size) if game["last_move"] else None
+            index = await choose_move(board_from_words(game["x_board"]), board_from_words(game["o_board"]), size,
+                                      game["grid_properties"]["winning_line"], last_index)
+            cell = cell_name(index)
+            game = await apply_move(game_id, BOT_USERNAME, cell, index)
+            if game is None:
+                # the game changed during the search, it is looked at again
+                failures += 1
+                continue
+            await complete_move(game_id, game, BOT_USERNAME, cell)
+            return
+        except Exception:
+            # nothing waits on this task, so a failure is logged here and the move tried again; once the
+            # attempts run out, the next poll of the game or pass of the archiver starts it again
+            failures += 1
+            logger.exception("Computer move in game %s failed (attempt %d of %d)", game_id, failures,
+                             BOT_MOVE_ATTEMPTS)
+            if failures < BOT_MOVE_ATTEMPTS:
+                await asyncio.sleep(BOT_RETRY_SECONDS)
+
+
+def schedule_bot_move(game: dict):
+    # the bot moves in the background, players see its move through the usual polls and events; a game
+    # has at most one task per process, which is asked to look again if it is already running
+    if not bot_to_move(game):
+        return
+    game_id = str(game["_id"])
+    if game_id in bot_tasks:
+        bot_wakeups.add(game_id)
+        return
+    bot_tasks[game_id] = asyncio.create_task(play_bot_move(game_id))
 
 
 @app.get("/poll_game")
-async def poll_game(game_id: str, username: str = Depends(verify_token)):
+async def poll_game(game_id: str, response: Response, if_none_match: str = Header(None),
+                    username: str = Depends(verify_token)):
     try:
-        game = games.find_one({"_id": ObjectId(game_id)})
+        game = await find_game(game_id)
         if game is None:
             raise HTTPException(status_code=404, detail="Game not found")
 
         if username != game["x_player_name"] and username != game["o_player_name"]:
             raise HTTPException(status_code=403, detail="You are not a player in this game")
+        # a bot move lost to failures or a restart is picked up when the player comes back
+        schedule_bot_move(game)
+
+        your_turn = game["x_turn"] == (username == game["x_player_name"])
+        etag = make_etag(game["version"])
+        retry_after = POLL_RETRY_AFTER_SECONDS if game["state"] == "ongoing" and not your_turn \
+            else IDLE_POLL_RETRY_AFTER_SECONDS
+        if etag_matches(etag, if_none_match):
+            return not_modified(etag, retry_after)
+        set_poll_headers(response, etag, retry_after)
 
         last_move = game["last_move"]
 
@@ -402,20 +660,68 @@ async def poll_game(game_id: str, username: str = Depends(verify_token)):
         handle_db_exception(e)
 
 
-@app.get("/get_ongoing_games")
-async def get_ongoing_games(username: str = Depends(verify_token)):
+@app.post("/poll_games")
+async def poll_games(request_body: PollGames, username: str = Depends(verify_token)):
+    # one request and one query for everything /poll_game and /poll_play_again_status report, for every game the
+    # player follows; only games whose version moved past the one the client sent are returned
+    if len(request_body.games) > MAX_PAGE_SIZE:
+        raise HTTPException(status_code=400, detail=f"At most {MAX_PAGE_SIZE} games can be polled at once")
+
     try:
-        search_query = {
-            "$or": [
-                {"x_player_name": username},
-                {"o_player_name": username}
-            ]
-        }
+        seen = {polled.game_id: polled.version for polled in request_body.games}
+        found = await find_games([game_id for game_id in seen if ObjectId.is_valid(game_id)])
+
+        changed = []
+        not_found = []
+        for game_id, version in seen.items():
+            game = found.get(game_id)
+            if game is None or username not in (game["x_player_name"], game["o_player_name"]):
+                not_found.append(game_id)
+            elif game["version"] != version:
+                changed.append({
+                    "game_id": game_id,
+                    "version": game["version"],
+                    "game_state": game["state"],
+                    "your_turn": game["x_turn"] == (username == game["x_player_name"]),
+                    "last_move": game["last_move"],
+                    "play_again_status": game["play_again_status"],
+                    "next_game_id": game["next_game_id"],
+                    "switch_sides": game["switch_sides"]
+                })
 
-        result = games.find(search_query)
+        return {"games": changed, "not_found": not_found}
+    except PyMongoError as e:
+        handle_db_exception(e)
+
+
+@app.get("/game_moves")
+async def game_moves(game_id: str, since: int = Query(0, ge=0), username: str = Depends(verify_token)):
+    try:
+        game = await find_game(game_id)
+        if game is None:
+            raise HTTPException(status_code=404, detail="Game not found")
+
+        if username != game["x_player_name"] and username != game["o_player_name"]:
+            raise HTTPException(status_code=403, detail="You are not a player in this game")
+
+        moves = []
+        if game["move_count"] > since:
+            game = await find_moves(game_id, since)
+            if game is None:
+                raise HTTPException(status_code=404, detail="Game not found")
+            moves = game["moves"]
 
+        return {"moves": moves, "move_count": game["move_count"], "game_state": game["state"]}
+    except PyMongoError as e:
+        handle_db_exception(e)
+
+
+@app.get("/get_ongoing_games")
+async def get_ongoing_games(limit: int = Query(DEFAULT_PAGE_SIZE, ge=1, le=MAX_PAGE_SIZE), after: str = None,
+                            username: str = Depends(verify_token)):
+    try:
         games_list = []
-        for game in result:
+        for game in await store.find_ongoing_games(username, limit, after):
             game_details = {
                 "game_id": str(game["_id"]),
                 "opponent": (game["o_player_name"] if username == game["x_player_name"] else game["x_player_name"]),
@@ -425,15 +731,135 @@ async def get_ongoing_games(username: str = Depends(verify_token)):
             }
             games_list.append(game_details)
 
-        return {"ongoing_games": games_list}
+        return {"ongoing_games": games_list, "next_after": next_page(games_list, limit, "game_id")}
     except PyMongoError as e:
         handle_db_exception(e)
 
 
+def stats_record(entry: dict):
+    return {
+        "wins": entry["wins"],
+        "losses": entry["losses"],
+        "draws": entry["draws"],
+        "games": entry["wins"] + entry["losses"] + entry["draws"]
+    }
+
+
+@app.get("/stats/{player}")
+async def get_stats(player: str, username: str = Depends(verify_token)):
+    try:
+        if await store.find_user(player) is None:
+            raise HTTPException(status_code=404, detail="User not found")
+
+        records = await store.find_player_stats(player)
+        totals = {field: sum(entry[field] for entry in records) for field in ("wins", "losses", "draws")}
+        return {
+            "username": player,
+            "totals": stats_record(totals),
+            "by_grid": [{"grid_properties": {"size": entry["size"], "winning_line": entry["winning_line"]},
+                         **stats_record(entry)} for entry in records]
+        }
+    except PyMongoError as e:
+        handle_db_exception(e)
+
+
+@app.get("/leaderboard")
+async def leaderboard(size: int, winning_line: int, limit: int = Query(DEFAULT_PAGE_SIZE, ge=1, le=MAX_PAGE_SIZE),
+                      after: str = None, username: str = Depends(verify_token)):
+    # players ranked by wins on one board configuration; after is the username that ended the previous page
+    try:
+        entries = [{"username": entry["username"], **stats_record(entry)}
+                   for entry in await store.find_leaderboard(size, winning_line, limit, after)]
+        return {"leaderboard": entries, "next_after": next_page(entries, limit, "username")}
+    except PyMongoError as e:
+        handle_db_exception(e)
+
+
+EXPORT_COLUMNS = ["game_id", "x_player_name", "o_player_name", "result", "size", "winning_line", "play_again_scheme",
+                  "finished_at", "moves"]
+
+
+def export_row(entry: dict):
+    return {
+        "game_id": str(entry["_id"]),
+        "x_player_name": entry["x_player_name"],
+        "o_player_name": entry["o_player_name"],
+        "result": entry["result"],
+        "size": entry["grid_properties"]["size"],
+        "winning_line": entry["grid_properties"]["winning_line"],
+        "play_again_scheme": entry["play_again_scheme"],
+        "finished_at": entry["finished_at"],
+        "moves": entry["moves"]
+    }
+
+
+def ndjson_line(row: dict):
+    return orjson.dumps(row, option=orjson.OPT_APPEND_NEWLINE)
+
+
+def csv_values(values: list):
+    buffer = io.StringIO()
+    csv.writer(buffer).writerow(values)
+    return buffer.getvalue().encode()
+
+
+def csv_line(row: dict):
+    return csv_values([row["finished_at"].isoformat() if column == "finished_at"
+                       else " ".join(row["moves"]) if column == "moves" else row[column]
+                       for column in EXPORT_COLUMNS])
+
+
+async def export_lines(header: bytes, first: dict, entries, encode):
+    yield header
+    entry = first
+    while entry is not None:
+        yield encode(export_row(entry))
+        entry = await anext(entries, None)
+
+
+@app.get("/export_games")
+async def export_games(export_format: str = Query("ndjson", alias="format"), username: str = Depends(verify_token)):
+    # every finished game of the player, one line each, streamed batch by batch from the database
+    if export_format not in ("ndjson", "csv"):
+        raise HTTPException(status_code=400, detail="Unknown export format")
+
+    entries = store.export_games(username)
+    try:
+        # errors on the first batch can still be reported, later ones cut the stream short
+        first = await anext(entries, None)
+    except PyMongoError as e:
+        handle_db_exception(e)
+
+    if export_format == "csv":
+        return StreamingResponse(export_lines(csv_values(EXPORT_COLUMNS), first, entries, csv_line),
+                                 media_type="text/csv",
+                                 headers={"Content-Disposition": 'attachment; filename="games.csv"'})
+    return StreamingResponse(export_lines(b"", first, entries, ndjson_line), media_type="application/x-ndjson")
+
+
+GRID_MEDIA_TYPES = {
+    "application/vnd.tictactoe.rows+json": "rows",
+    "application/vnd.tictactoe.bitboard+json": "bitboard"
+}
+
+
+def encode_grid(game: dict, grid_format: str):
+    size = game["grid_properties"]["size"]
+    x_board = board_from_words(game["x_board"])
+    o_board = board_from_words(game["o_board"])
+    if grid_format == "rows":
+        return board_to_rows(x_board, o_board, size)
+    elif grid_format == "bitboard":
+        return {"x": board_to_base64(x_board, size), "o": board_to_base64(o_board, size)}
+    else:
+        return board_to_grid(x_board, o_board, size)
+
+
 @app.get("/get_full_game_state")
-async def get_full_game_state(game_id: str, username: str = Depends(verify_token)):
+async def get_full_game_state(game_id: str, grid_format: str = None, accept: str = Header(None),
+                              username: str = Depends(verify_token)):
     try:
-        game = games.find_one({"_id": ObjectId(game_id)})
+        game = await find_game(game_id)
         if game is None:
             raise HTTPException(status_code=404, detail="Game not found")
 
@@ -447,6 +873,13 @@ async def get_full_game_state(game_id: str, username: str = Depends(verify_token
             opponent = game["x_player_name"]
         else:
             raise HTTPException(status_code=403, detail="You are not a player in this game")
+        schedule_bot_move(game)
+
+        if grid_format is None:
+            grid_format = next((grid_format for media_type, grid_format in GRID_MEDIA_TYPES.items()
+                                if accept and media_type in accept), "list")
+        if grid_format not in ("list", "rows", "bitboard"):
+            raise HTTPException(status_code=400, detail="Unknown grid format")
 
         return {
             "status": game["state"],
@@ -454,48 +887,54 @@ async def get_full_game_state(game_id: str, username: str = Depends(verify_token
             "opponent": opponent,
             "you_playing_x": user_playing_x,
             "your_turn": user_turn,
-            "grid_state": game["grid_state"],
+            "grid_format": grid_format,
+            "grid_state": encode_grid(game, grid_format),
             "play_again_scheme": game["play_again_scheme"],
             "play_again_status": game["play_again_status"],
-            "next_game_id": game["next_game_id"]
+            "next_game_id": game["next_game_id"],
+            "public": game.get("public", False),
+            "spectator_key": game.get("spectator_key")
         }
     except PyMongoError as e:
         handle_db_exception(e)
 
 
-def play_again_accepted(game: dict):
+async def play_again_accepted(game: dict):
     try:
         if (game["play_again_scheme"] == "alternating" or
                 (game["play_again_scheme"] == "winner_plays_x" and game["state"] == "won_by_o") or
                 (game["play_again_scheme"] == "winner_plays_o" and game["state"] == "won_by_x")):
-            game["switch_sides"] = True
+            switch_sides = True
         else:
-            game["switch_sides"] = False
-
-        game["next_game_id"] = create_game(x_player=(game["o_player_name"] if game["switch_sides"]
-                                                     else game["x_player_name"]),
-                                           o_player=(game["x_player_name"] if game["switch_sides"]
-                                                     else game["o_player_name"]),
-                                           size=game["grid_properties"]["size"],
-                                           winning_line=game["grid_properties"]["winning_line"],
-                                           play_again_scheme=game["play_again_scheme"])
-
-        update = {
-            "$set": {
-                "play_again_status": "accepted",
-                "switch_sides": game["switch_sides"],
-                "next_game_id": game["next_game_id"]
-            }
+            switch_sides = False
+
+        # the conditional update on the old game picks the one accept that creates the next game
+        next_game_id = ObjectId()
+        changes = {
+            "play_again_status": "accepted",
+            "switch_sides": switch_sides,
+            "next_game_id": str(next_game_id)
         }
-        games.update_one({"_id": ObjectId(game["_id"])}, update)
+        async with store.transaction():
+            if not await update_game(game, changes):
+                raise HTTPException(status_code=409, detail="Game changed, try again")
+            await create_game(x_player=game["o_player_name"] if switch_sides else game["x_player_name"],
+                              o_player=game["x_player_name"] if switch_sides else game["o_player_name"],
+                              size=game["grid_properties"]["size"],
+                              winning_line=game["grid_properties"]["winning_line"],
+                              play_again_scheme=game["play_again_scheme"],
+                              game_id=next_game_id,
+                              public=game.get("public", False))
     except PyMongoError as e:
+        # a rolled back transition must not be served from the cache
+        game_cache.invalidate(str(game["_id"]))
         handle_db_exception(e)
 
 
 @app.post("/play_again")
 async def play_again(request_body: PlayAgain, username: str = Depends(verify_token)):
     try:
-        game = games.find_one({"_id": ObjectId(request_body.game_id)})
+        game = await find_game(request_body.game_id)
 
         if game is None:
             raise HTTPException(status_code=404, detail="Game not found")
@@ -510,21 +949,33 @@ async def play_again(request_body: PlayAgain, username: str = Depends(verify_tok
             if game["play_again_status"] == "declined":
                 raise HTTPException(status_code=409, detail="Play again was declined")
 
-            if game["play_again_status"] is None:
-                game["play_again_status"] = "requested_by_x" if username == game["x_player_name"] else "requested_by_o"
-                update = {"$set": {"play_again_status": "requested_by_x"
-                                                        if username == game["x_player_name"]
-                                                        else "requested_by_o"}}
-                games.update_one({"_id": ObjectId(request_body.game_id)}, update)
+            opponent = game["o_player_name"] if username == game["x_player_name"] else game["x_player_name"]
+            if game["play_again_status"] is None and opponent != BOT_USERNAME:
+                changes = {"play_again_status": "requested_by_x"
+                                                 if username == game["x_player_name"]
+                                                 else "requested_by_o"}
+                if not await update_game(game, changes):
+                    raise HTTPException(status_code=409, detail="Game changed, try again")
+                await publish(game_channel(request_body.game_id),
+                              {"event": "play_again", "play_again_status": game["play_again_status"]})
                 return {"status": "Waiting for opponent to accept"}
 
             if game["play_again_status"] == "requested_by_x" and username == game["x_player_name"] or \
                     game["play_again_status"] == "requested_by_o" and username == game["o_player_name"]:
                 return {"status": "Waiting for opponent to accept"}
 
+            # with the computer as the opponent nothing was requested yet, it accepts straight away
             if game["play_again_status"] == "requested_by_x" and username == game["o_player_name"] or \
-                    game["play_again_status"] == "requested_by_o" and username == game["x_player_name"]:
-                play_again_accepted(game)
+                    game["play_again_status"] == "requested_by_o" and username == game["x_player_name"] or \
+                    game["play_again_status"] is None:
+                await play_again_accepted(game)
+                await publish(game_channel(request_body.game_id), {
+                    "event": "play_again",
+                    "play_again_status": "accepted",
+                    "next_game_id": game["next_game_id"],
+                    "switch_sides": game["switch_sides"]
+                })
+                schedule_bot_move(await find_game(game["next_game_id"]))
                 return {
                     "status": "New game started",
                     "new_game_id": game["next_game_id"],
@@ -540,7 +991,7 @@ async def play_again(request_body: PlayAgain, username: str = Depends(verify_tok
 
         else:
             if game["play_again_status"] == "accepted":
-                return JSONResponse(
+                return ORJSONResponse(
                     status_code=409,
                     content={
                         "detail": "Play again already accepted",
@@ -549,16 +1000,19 @@ async def play_again(request_body: PlayAgain, username: str = Depends(verify_tok
                     }
                 )
 
-            games.update_one({"_id": ObjectId(game["_id"])}, {"$set": {"play_again_status": "declined"}})
+            if not await update_game(game, {"play_again_status": "declined"}):
+                raise HTTPException(status_code=409, detail="Game changed, try again")
+            await publish(game_channel(request_body.game_id), {"event": "play_again", "play_again_status": "declined"})
             return {"status": "Play again declined"}
     except PyMongoError as e:
         handle_db_exception(e)
 
 
 @app.get("/poll_play_again_status")
-async def poll_play_again_status(game_id: str, username: str = Depends(verify_token)):
+async def poll_play_again_status(game_id: str, response: Response, if_none_match: str = Header(None),
+                                 username: str = Depends(verify_token)):
     try:
-        game = games.find_one({"_id": ObjectId(game_id)})
+        game = await find_game(game_id)
 
         if game is None:
             raise HTTPException(status_code=404, detail="Game not found")
@@ -566,6 +1020,13 @@ async def poll_play_again_status(game_id: str, username: str = Depends(verify_to
         if username != game["x_player_name"] and username != game["o_player_name"]:
             raise HTTPException(status_code=403, detail="You are not a player in this game")
 
+        etag = make_etag(game["version"])
+        retry_after = IDLE_POLL_RETRY_AFTER_SECONDS if game["play_again_status"] in ("accepted", "declined") \
+            else POLL_RETRY_AFTER_SECONDS
+        if etag_matches(etag, if_none_match):
+            return not_modified(etag, retry_after)
+        set_poll_headers(response, etag, retry_after)
+
         if game["play_again_status"] == "accepted":
             return {
                 "play_again_status": game["play_again_status"],
@@ -576,3 +1037,97 @@ async def poll_play_again_status(game_id: str, username: str = Depends(verify_to
             return {"play_again_status": game["play_again_status"]}
     except PyMongoError as e:
         handle_db_exception(e)
+
+
+async def forward_events(websocket: WebSocket, subscription):
+    async for event in subscription:
+        await websocket.send_json(event)
+
+
+async def drain_messages(websocket: WebSocket):
+    # clients don't send anything, reading only notices when they go away
+    try:
+        while True:
+            await websocket.receive_text()
+    except WebSocketDisconnect:
+        pass
+
+
+@app.websocket("/ws/game/{game_id}")
+async def game_websocket(websocket: WebSocket, game_id: str, token: str = None, authorization: str = Header(None)):
+    if token is None and authorization is not None and authorization.lower().startswith("bearer "):
+        token = authorization[len("bearer "):]
+
+    try:
+        username = decode_token(token)
+    except jwt.InvalidTokenError:
+        await websocket.close(code=status.WS_1008_POLICY_VIOLATION)
+        return
+
+    try:
+        with subscribe(game_channel(game_id)) as subscription:
+            game = await find_game(game_id)
+            if game is None or username not in (game["x_player_name"], game["o_player_name"]):
+                await websocket.close(code=status.WS_1008_POLICY_VIOLATION)
+                return
+
+            await websocket.accept()
+            await websocket.send_json({
+                "event": "subscribed",
+                "game_state": game["state"],
+                "move_count": game["move_count"],
+                "last_move": game["last_move"],
+                "play_again_status": game["play_again_status"]
+            })
+
+            tasks = [asyncio.create_task(forward_events(websocket, subscription)),
+                     asyncio.create_task(drain_messages(websocket))]
+            done, pending = await asyncio.wait(tasks, return_when=asyncio.FIRST_COMPLETED)
+            for task in pending:
+                task.cancel()
+            if subscription.dropped:
+                await websocket.close(code=status.WS_1013_TRY_AGAIN_LATER)
+    except PyMongoError:
+        await websocket.close(code=status.WS_1011_INTERNAL_ERROR)
+
+
+@app.get("/spectate/{game_id}")
+async def spectate(game_id: str, key: str = None):
+    try:
+        spectator = await spectators.join(game_id, key)
+    except PyMongoError as e:
+        handle_db_exception(e)
+    return StreamingResponse(spectator.sse_stream(), media_type="text/event-stream",
+                             headers={"Cache-Control": "no-cache"})
+
+
+async def forward_frames(websocket: WebSocket, spectator):
+    while True:
+        frame = await spectator.next_frame()
+        if frame is None:
+            return
+        await websocket.send_text(frame.text)
+
+
+@app.websocket("/ws/spectate/{game_id}")
+async def spectate_websocket(websocket: WebSocket, game_id: str, key: str = None):
+    try:
+        spectator = await spectators.join(game_id, key)
+    except HTTPException:
+        await websocket.close(code=status.WS_1008_POLICY_VIOLATION)
+        return
+    except PyMongoError:
+        await websocket.close(code=status.WS_1011_INTERNAL_ERROR)
+        return
+
+    try:
+        await websocket.accept()
+        tasks = [asyncio.create_task(forward_frames(websocket, spectator)),
+                 asyncio.create_task(drain_messages(websocket))]
+        done, pending = await asyncio.wait(tasks, return_when=asyncio.FIRST_COMPLETED)
+        for task in pending:
+            task.cancel()
+        if spectator.dropped:
+            await websocket.close(code=status.WS_1013_TRY_AGAIN_LATER)
+    finally:
+        spectator.leave()
@@ -0,0 +1,37 @@
+from bson import ObjectId
+from storage import store
+from game import create_game
+
+# Matchmaking tickets live in waiting_users next to the entries of /start_waiting. A ticket
+# is claimed by setting matched_game_id, which only one request can do, and it is handed over
+# to its owner on their next /matchmake call.
+
+
+def preferences(size: int, winning_line: int, play_again_scheme: str):
+    return {"size": size, "winning_line": winning_line, "play_again_scheme": play_again_scheme}
+
+
+async def take_ticket(username: str):
+    # removes the user's ticket from the queue so nobody can claim it while they look for a partner;
+    # a ticket that was already claimed is returned to report the match
+    return await store.take_ticket(username)
+
+
+async def claim_partner(username: str, size: int, winning_line: int, play_again_scheme: str):
+    game_id = ObjectId()
+    # claims the oldest unclaimed ticket of someone else with the same preferences
+    partner = await store.claim_ticket(username, preferences(size, winning_line, play_again_scheme), str(game_id))
+    if partner is None:
+        return None
+
+    await create_game(partner["username"], username, size, winning_line, play_again_scheme, game_id=game_id)
+    return partner
+
+
+async def enter_queue(username: str, size: int, winning_line: int, play_again_scheme: str):
+    ticket = {
+        "username": username,
+        "matchmaking": preferences(size, winning_line, play_again_scheme),
+        "matched_game_id": None
+    }
+    await store.put_ticket(ticket)
@@ -0,0 +1,87 @@
+import argparse
+import asyncio
+import secrets
+from pymongo import UpdateOne
+from bitboard import board_to_words, cell_index
+from database import games, close_db
+
+# Games stored before boards became bitboards keep the grid as a grid_state list of rows of
+# 'X', 'O' and ''. They have no x_board, o_board, move_count, version, moves, updated_at or
+# spectator_key, and the server can't load them. This converts them in place; it only touches
+# games that still have a grid_state, so it can be run again or stopped and resumed.
+#
+# The order of the moves of these games was never stored. The log written for them alternates
+# X and O over the cells in row order and ends with the recorded last move, so replaying it gives
+# the right final position, but not the order the game was played in.
+
+
+def cell_name(row: int, column: int):
+    return chr(ord('a') + row) + str(column + 1)
+
+
+def legacy_moves(game: dict):
+    cells = {"X": [], "O": []}
+    for row, cells_in_row in enumerate(game["grid_state"]):
+        for column, token in enumerate(cells_in_row):
+            if token:
+                cells[token].append(cell_name(row, column))
+
+    last_move = game.get("last_move")
+    if last_move:
+        token = "X" if last_move["player_name"] == game["x_player_name"] else "O"
+        if last_move["cell"].lower() in cells[token]:
+            cells[token].remove(last_move["cell"].lower())
+            cells[token].append(last_move["cell"].lower())
+
+    moves = []
+    for seq in range(1, len(cells["X"]) + len(cells["O"]) + 1):
+        token = "X" if seq % 2 else "O"
+        player_name = game["x_player_name"] if token == "X" else game["o_player_name"]
+        moves.append({"seq": seq, "player_name": player_name, "cell": cells[token][(seq - 1) // 2]})
+    return moves
+
+
+def converted(game: dict):
+    size = game["grid_properties"]["size"]
+    boards = {"X": 0, "O": 0}
+    for row, cells_in_row in enumerate(game["grid_state"]):
+        for column, token in enumerate(cells_in_row):
+            if token:
+                boards[token] |= 1 << cell_index(row, column)
+
+    moves = legacy_moves(game)
+    return {
+        "x_board": board_to_words(boards["X"], size),
+        "o_board": board_to_words(boards["O"], size),
+        "move_count": len(moves),
+        "moves": moves,
+        "version": 0,
+        "public": False,
+        "spectator_key": secrets.token_urlsafe(16),
+        # the creation time is the best guess there is at when the game last changed
+        "updated_at": game["_id"].generation_time
+    }
+
+
+async def migrate(batch_size: int):
+    migrated = 0
+    legacy = games.find({"grid_state": {"$exists": True}}).sort("_id", 1).batch_size(batch_size)
+    batch = []
+    async for game in legacy:
+        batch.append(UpdateOne({"_id": game["_id"], "grid_state": {"$exists": True}},
+                               {"$set": converted(game), "$unset": {"grid_state": ""}}))
+        if len(batch) == batch_size:
+            migrated += (await games.bulk_write(batch, ordered=False)).modified_count
+            batch = []
+    if batch:
+        migrated += (await games.bulk_write(batch, ordered=False)).modified_count
+    return migrated
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Converts games stored with a grid_state to the bitboard format")
+    parser.add_argument("--batch-size", type=int, default=500, help="games converted per bulk write")
+    args = parser.parse_args()
+
+    print(f"{asyncio.run(migrate(args.batch_size))} games converted")
+    close_db()
@@ -0,0 +1,58 @@
+import asyncio
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor
+from argon2 import PasswordHasher
+from fastapi.exceptions import HTTPException
+from prometheus_client import Counter, Gauge, Histogram
+
+# argon2-cffi releases the GIL while hashing, so a thread pool hashes in parallel
+HASH_WORKERS = int(os.getenv("HASH_WORKERS", str(os.cpu_count() or 1)))
+HASH_QUEUE_LIMIT = int(os.getenv("HASH_QUEUE_LIMIT", "16"))
+
+ph = PasswordHasher()
+executor = ThreadPoolExecutor(max_workers=HASH_WORKERS, thread_name_prefix="argon2")
+in_flight = 0
+
+hash_queue_depth = Gauge("password_hash_queue_depth", "Password hash jobs waiting for a worker")
+hash_in_flight = Gauge("password_hash_in_flight", "Password hash jobs queued or running")
+hash_rejected = Counter("password_hash_rejected_total", "Password hash jobs rejected because the queue was full")
+hash_wait_seconds = Histogram("password_hash_wait_seconds", "Time password hash jobs spent waiting for a worker")
+hash_seconds = Histogram("password_hash_seconds", "Time spent hashing or verifying a password", ["operation"])
+hash_in_flight.set_function(lambda: in_flight)
+hash_queue_depth.set_function(lambda: max(0, in_flight - HASH_WORKERS))
+
+
+def timed(operation: str, function, submitted: float):
+    started = time.perf_counter()
+    hash_wait_seconds.observe(started - submitted)
+    try:
+        return function()
+    finally:
+        hash_seconds.labels(operation).observe(time.perf_counter() - started)
+
+
+async def run_in_pool(operation: str, function):
+    global in_flight
+    if in_flight >= HASH_WORKERS + HASH_QUEUE_LIMIT:
+        hash_rejected.inc()
+        raise HTTPException(status_code=503, detail="Server is busy, try again later", headers={"Retry-After": "1"})
+
+    in_flight += 1
+    try:
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(executor, timed, operation, function, time.perf_counter())
+    finally:
+        in_flight -= 1
+
+
+async def hash_password(password: str):
+    return await run_in_pool("hash", lambda: ph.hash(password))
+
+
+async def verify_password(hashed_password: str, password: str):
+    return await run_in_pool("verify", lambda: ph.verify(hashed_password, password))
+
+
+def close_pool():
+    executor.shutdown(wait=True)
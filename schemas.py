@@ -1,3 +1,4 @@
+from typing import List, Optional
 from pydantic import BaseModel
 
 
@@ -11,6 +12,12 @@ class Invitation(BaseModel):
     grid_properties: GridProperties
     inviter_playing_x: bool
     play_again_scheme: str = "same"
+    public: bool = False
+
+
+class MatchmakingRequest(BaseModel):
+    grid_properties: GridProperties
+    play_again_scheme: str = "same"
 
 
 class NewMove(BaseModel):
@@ -23,6 +30,15 @@ class InvitationResponse(BaseModel):
     response: str
 
 
+class PolledGame(BaseModel):
+    game_id: str
+    version: Optional[int] = None
+
+
+class PollGames(BaseModel):
+    games: List[PolledGame]
+
+
 class PlayAgain(BaseModel):
     game_id: str
     play_again: bool
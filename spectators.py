@@ -0,0 +1,213 @@
+import asyncio
+import os
+import secrets
+import orjson
+from fastapi.exceptions import HTTPException
+from pymongo.errors import PyMongoError
+from prometheus_client import Counter, Gauge
+from bitboard import board_from_words
+from events import subscribe, game_channel
+from game import find_game, parse_cell, board_to_rows
+
+# Each process keeps one feed per spectated game. The feed holds the only event subscription and
+# the only game read for the game, keeps a snapshot up to date from the events, and hands every
+# event, serialized once, to the bounded queue of each spectator. Spectators that fall behind
+# are dropped rather than buffered.
+SPECTATOR_QUEUE_SIZE = int(os.getenv("SPECTATOR_QUEUE_SIZE", "32"))
+SPECTATOR_KEEPALIVE_SECONDS = float(os.getenv("SPECTATOR_KEEPALIVE_SECONDS", "15"))
+
+spectators_connected = Gauge("spectators_connected", "Spectator connections open")
+spectators_dropped = Counter("spectators_dropped_total", "Spectators dropped for falling behind")
+spectated_games = Gauge("spectated_games", "Games with at least one spectator in this process")
+
+feeds = {}
+
+
+class Frame:
+    # an event serialized once, as JSON text for WebSockets and as a server-sent event
+    def __init__(self, event: dict):
+        self.text = orjson.dumps(event).decode()
+        self.sse = f"event: {event['event']}\ndata: {self.text}\n\n".encode()
+
+
+class Spectator:
+    def __init__(self, feed):
+        self.feed = feed
+        self.queue = asyncio.Queue(maxsize=SPECTATOR_QUEUE_SIZE)
+        self.dropped = False
+        self.left = False
+
+    def deliver(self, frame: Frame):
+        try:
+            self.queue.put_nowait(frame)
+        except asyncio.QueueFull:
+            self.dropped = True
+            spectators_dropped.inc()
+            self.end()
+
+    def end(self):
+        # stops the stream after what was already taken from the queue
+        # the queue is emptied rather than replaced, so a consumer already waiting on it wakes up
+        self.feed.spectators.discard(self)
+        while not self.queue.empty():
+            self.queue.get_nowait()
+        self.queue.put_nowait(None)
+
+    async def next_frame(self, timeout: float = None):
+        # returns the next frame, None once dropped, or "" if nothing came within the timeout
+        try:
+            return await asyncio.wait_for(self.queue.get(), timeout)
+        except asyncio.TimeoutError:
+            return ""
+
+    async def sse_stream(self):
+        try:
+            while True:
+                frame = await self.next_frame(SPECTATOR_KEEPALIVE_SECONDS)
+                if frame is None:
+                    break
+                # a comment line keeps proxies from closing an idle stream
+                yield frame.sse if frame else b": keepalive\n\n"
+        finally:
+            self.leave()
+
+    def leave(self):
+        if not self.left:
+            self.left = True
+            self.feed.leave(self)
+
+
+class GameFeed:
+    def __init__(self, game_id: str):
+        self.game_id = game_id
+        self.spectators = set()
+        self.watchers = 0
+        self.game = None
+        self.snapshot = None
+        self.subscription = subscribe(game_channel(game_id)).__enter__()
+        self.ready = asyncio.ensure_future(self.load())
+        self.pump = None
+        spectated_games.inc()
+
+    async def load(self):
+        game = await find_game(self.game_id)
+        if game is None:
+            return False
+
+        self.game = {
+            "x_player_name": game["x_player_name"],
+            "o_player_name": game["o_player_name"],
+            "grid_properties": game["grid_properties"],
+            "x_board": board_from_words(game["x_board"]),
+            "o_board": board_from_words(game["o_board"]),
+            "move_count": game["move_count"],
+            "last_move": game["last_move"],
+            "game_state": game["state"],
+            "play_again_status": game["play_again_status"],
+            "next_game_id": game["next_game_id"],
+            "public": game.get("public", False),
+            "spectator_key": game.get("spectator_key")
+        }
+        self.snapshot = None
+        if self.pump is None:
+            self.pump = asyncio.create_task(self.forward())
+        return True
+
+    def allows(self, key: str):
+        return self.game["public"] or \
+            (key is not None and self.game["spectator_key"] is not None and
+             secrets.compare_digest(key, self.game["spectator_key"]))
+
+    def snapshot_frame(self):
+        if self.snapshot is None:
+            game = self.game
+            self.snapshot = Frame({
+                "event": "snapshot",
+                "x_player_name": game["x_player_name"],
+                "o_player_name": game["o_player_name"],
+                "grid_properties": game["grid_properties"],
+                "grid_state": board_to_rows(game["x_board"], game["o_board"], game["grid_properties"]["size"]),
+                "move_count": game["move_count"],
+                "last_move": game["last_move"],
+                "game_state": game["game_state"],
+                "play_again_status": game["play_again_status"],
+                "next_game_id": game["next_game_id"]
+            })
+        return self.snapshot
+
+    def apply(self, event: dict):
+        game = self.game
+        if event["event"] == "move":
+            index = parse_cell(event["cell"], game["grid_properties"]["size"])
+            board = "x_board" if event["player_name"] == game["x_player_name"] else "o_board"
+            game[board] |= 1 << index
+            game["move_count"] = event["move_count"]
+            game["last_move"] = {"player_name": event["player_name"], "cell": event["cell"]}
+            game["game_state"] = event["game_state"]
+        elif event["event"] == "state_change":
+            game["game_state"] = event["game_state"]
+        elif event["event"] == "play_again":
+            game["play_again_status"] = event["play_again_status"]
+            game["next_game_id"] = event.get("next_game_id", game["next_game_id"])
+        self.snapshot = None
+
+    def broadcast(self, frame: Frame):
+        for spectator in list(self.spectators):
+            spectator.deliver(frame)
+
+    async def forward(self):
+        while True:
+            async for event in self.subscription:
+                self.apply(event)
+                self.broadcast(Frame(event))
+
+            # the feed itself fell behind and was dropped: subscribe again and send everyone a fresh snapshot
+            self.subscription = subscribe(game_channel(self.game_id)).__enter__()
+            try:
+                loaded = await self.load()
+            except PyMongoError:
+                loaded = False
+            if not loaded:
+                for spectator in list(self.spectators):
+                    spectator.end()
+                return
+            self.broadcast(self.snapshot_frame())
+
+    def leave(self, spectator: Spectator):
+        self.spectators.discard(spectator)
+        self.watchers -= 1
+        spectators_connected.dec()
+        if self.watchers == 0:
+            self.close()
+
+    def close(self):
+        if feeds.get(self.game_id) is self:
+            del feeds[self.game_id]
+        if self.pump is not None:
+            self.pump.cancel()
+        self.ready.cancel()
+        self.subscription.__exit__(None, None, None)
+        spectated_games.dec()
+
+
+async def join(game_id: str, key: str):
+    # the first spectator of a game reads it once, everyone after that is served from the feed
+    feed = feeds.get(game_id)
+    if feed is None:
+        feed = feeds[game_id] = GameFeed(game_id)
+
+    spectator = Spectator(feed)
+    feed.watchers += 1
+    spectators_connected.inc()
+    try:
+        if not await asyncio.shield(feed.ready):
+            raise HTTPException(status_code=404, detail="Game not found")
+        if not feed.allows(key):
+            raise HTTPException(status_code=403, detail="This game is not open to spectators")
+    except BaseException:
+        spectator.leave()
+        raise
+
+    spectator.deliver(feed.snapshot_frame())
+    feed.spectators.add(spectator)
+    return spectator
@@ -0,0 +1,668 @@
+import os
+from bisect import bisect_left, bisect_right, insort
+from collections import defaultdict
+from contextlib import asynccontextmanager
+from contextvars import ContextVar
+from datetime import datetime, timedelta, timezone
+from itertools import islice
+from bson import ObjectId
+from pymongo import ReturnDocument, UpdateOne
+from pymongo.errors import DuplicateKeyError
+from bitboard import MAX_GRID_SIZE, WORD_BITS
+from database import (client, users, waiting_users, invitations, games, game_history, player_stats, init_db, close_db,
+                      INVITATION_RETENTION_SECONDS, WAITING_USER_TTL_SECONDS)
+
+# STORAGE_BACKEND=mongo keeps users, waiting users, invitations and games in MongoDB.
+# STORAGE_BACKEND=memory keeps them in dicts in this process, for single-process
+# deployments, benchmarks and tests; everything is lost on restart.
+STORAGE_BACKEND = os.getenv("STORAGE_BACKEND", "mongo")
+
+# Accepting an invitation or a play-again request is a conditional transition followed by the
+# writes it unlocks. With MONGO_TRANSACTIONS=1 they commit together, which needs a replica set;
+# without it the transition alone decides the single winner.
+MONGO_TRANSACTIONS = os.getenv("MONGO_TRANSACTIONS", "0") == "1"
+
+# the session of the transaction the current request runs in, if any
+current_session = ContextVar("current_session", default=None)
+
+# the move log is only read through find_moves, everything else loads games without it
+GAME_PROJECTION = {"moves": 0}
+MAX_MOVES = MAX_GRID_SIZE * MAX_GRID_SIZE
+# what /poll_invitation_status reads of an invitation
+INVITATION_STATUS_PROJECTION = {"inviter": 1, "status": 1, "game_id": 1, "version": 1}
+FINISHED_STATES = ["won_by_x", "won_by_o", "draw", "timed_out"]
+# exports hold one batch of games in memory at a time
+EXPORT_BATCH_SIZE = int(os.getenv("EXPORT_BATCH_SIZE", "500"))
+EXPORT_PROJECTION = {"x_player_name": 1, "o_player_name": 1, "state": 1, "grid_properties": 1, "play_again_scheme": 1,
+                     "moves.cell": 1, "updated_at": 1}
+
+
+def now():
+    return datetime.now(timezone.utc)
+
+
+def history_entry(game: dict):
+    # finished games are archived with only what is needed to replay them; X always moves first,
+    # so the cells alone give the moves of both players
+    return {
+        "_id": game["_id"],
+        "x_player_name": game["x_player_name"],
+        "o_player_name": game["o_player_name"],
+        "result": game["state"],
+        "grid_properties": game["grid_properties"],
+        "play_again_scheme": game["play_again_scheme"],
+        "moves": [move["cell"] for move in game["moves"]],
+        "finished_at": game["updated_at"]
+    }
+
+
+async def merge_by_id(finished, archived):
+    # Merges two streams of history entries sorted by _id. A game archived while an export runs
+    # can be in both, and comes out once without remembering what was already sent.
+    game = await anext(finished, None)
+    entry = await anext(archived, None)
+    while game is not None or entry is not None:
+        if entry is None or (game is not None and game["_id"] < entry["_id"]):
+            yield game
+            game = await anext(finished, None)
+        else:
+            yield entry
+            if game is not None and game["_id"] == entry["_id"]:
+                game = await anext(finished, None)
+            entry = await anext(archived, None)
+
+
+def outcome_fields(state: str):
+    # the counter a finished game adds to the record of X and of O
+    return {"won_by_x": ("wins", "losses"), "won_by_o": ("losses", "wins"), "draw": ("draws", "draws")}[state]
+
+
+def stats_entry(username: str, size: int, winning_line: int):
+    return {"username": username, "size": size, "winning_line": winning_line, "wins": 0, "losses": 0, "draws": 0}
+
+
+def page_query(after: str):
+    # listings are paginated by _id, the id of the last item of a page is the cursor for the next one
+    return {"_id": {"$gt": ObjectId(after)}} if after else {}
+
+
+def move_position(index: int):
+    # the stored word and bit of the cell, and the smallest grid size it is on minus one
+    word, bit = divmod(index, WORD_BITS)
+    row, column = divmod(index, MAX_GRID_SIZE)
+    return word, bit, max(row, column)
+
+
+class MongoStorage:
+    async def start(self):
+        await init_db()
+
+    async def stop(self):
+        close_db()
+
+    @asynccontextmanager
+    async def transaction(self):
+        if not MONGO_TRANSACTIONS or current_session.get() is not None:
+            yield
+            return
+
+        async with await client.start_session() as session:
+            async with session.start_transaction():
+                token = current_session.set(session)
+                try:
+                    yield
+                finally:
+                    current_session.reset(token)
+
+    async def insert_user(self, user: dict):
+        await users.insert_one(user)
+
+    async def find_user(self, username: str):
+        return await users.find_one({"username": username})
+
+    async def delete_user(self, username: str):
+        await users.delete_one({"username": username})
+        await player_stats.delete_many({"username": username})
+
+    async def add_waiting_user(self, username: str):
+        await waiting_users.insert_one({"username": username, "waiting_since": now()})
+
+    async def remove_waiting_user(self, username: str):
+        await waiting_users.delete_one({"username": username})
+
+    async def remove_waiting_users(self, usernames: list):
+        await waiting_users.delete_many({"username": {"$in": usernames}}, session=current_session.get())
+
+    async def is_waiting(self, username: str):
+        return await waiting_users.find_one({"username": username}, {"_id": 1}) is not None
+
+    async def find_waiting_users(self, limit: int, after: str):
+        result = waiting_users.find(page_query(after), {"username": 1}).sort("_id", 1).limit(limit)
+        return [user async for user in result]
+
+    async def take_ticket(self, username: str):
+        return await waiting_users.find_one_and_delete({"username": username, "matchmaking": {"$exists": True}})
+
+    async def claim_ticket(self, username: str, preferences: dict, game_id: str):
+        return await waiting_users.find_one_and_update(
+            {**{"matchmaking." + key: value for key, value in preferences.items()},
+             "matched_game_id": None, "username": {"$ne": username}},
+            {"$set": {"matched_game_id": game_id}},
+            sort=[("_id", 1)],
+            return_document=ReturnDocument.AFTER
+        )
+
+    async def put_ticket(self, ticket: dict):
+        await waiting_users.replace_one({"username": ticket["username"]}, {**ticket, "waiting_since": now()},
+                                        upsert=True)
+
+    async def insert_invitation(self, invitation: dict):
+        return str((await invitations.insert_one(invitation)).inserted_id)
+
+    async def find_invitation(self, invitation_id: str):
+        return await invitations.find_one({"_id": ObjectId(invitation_id)})
+
+    async def find_invitation_status(self, invitation_id: str):
+        return await invitations.find_one({"_id": ObjectId(invitation_id)}, INVITATION_STATUS_PROJECTION)
+
+    async def find_received_invitations(self, username: str, limit: int, after: str):
+        projection = {"inviter": 1, "grid_properties": 1, "inviter_playing_x": 1, "play_again_scheme": 1,
+                      "version": 1}
+        result = invitations.find({"invited": username, "status": "pending", **page_query(after)},
+                                  projection).sort("_id", 1).limit(limit)
+        return [invitation async for invitation in result]
+
+    async def find_sent_invitations(self, username: str, limit: int, after: str):
+        projection = {"invited": 1, "grid_properties": 1, "inviter_playing_x": 1, "play_again_scheme": 1,
+                      "status": 1, "game_id": 1}
+        result = invitations.find({"inviter": username, "status": "pending", **page_query(after)},
+                                  projection).sort("_id", 1).limit(limit)
+        return [invitation async for invitation in result]
+
+    async def update_invitation(self, invitation_id: str, changes: dict, conditions: dict = None):
+        # every update ends the invitation, finished_at starts its retention period; returns the
+        # invitation as it was before the update, or None if there is none matching the conditions
+        return await invitations.find_one_and_update({"_id": ObjectId(invitation_id), **(conditions or {})},
+                                                     {"$set": {**changes, "finished_at": now()},
+                                                      "$inc": {"version": 1}},
+                                                     session=current_session.get())
+
+    async def insert_game(self, game: dict):
+        game["updated_at"] = now()
+        return str((await games.insert_one(game, session=current_session.get())).inserted_id)
+
+    async def find_game(self, game_id: str):
+        return await games.find_one({"_id": ObjectId(game_id)}, GAME_PROJECTION)
+
+    async def find_games(self, game_ids: list):
+        result = games.find({"_id": {"$in": [ObjectId(game_id) for game_id in game_ids]}}, GAME_PROJECTION)
+        return [game async for game in result]
+
+    async def find_ongoing_games(self, username: str, limit: int, after: str):
+        search_query = {
+            "$or": [
+                {"x_player_name": username, "state": "ongoing", **page_query(after)},
+                {"o_player_name": username, "state": "ongoing", **page_query(after)}
+            ]
+        }
+        projection = {"x_player_name": 1, "o_player_name": 1, "grid_properties": 1, "play_again_scheme": 1}
+        result = games.find(search_query, projection).sort("_id", 1).limit(limit)
+        return [game async for game in result]
+
+    async def update_game(self, game_id: ObjectId, version: int, changes: dict):
+        result = await games.update_one({"_id": game_id, "version": version},
+                                        {"$set": changes, "$inc": {"version": 1}, "$currentDate": {"updated_at": True}},
+                                        session=current_session.get())
+        return result.modified_count > 0
+
+    async def apply_move(self, game_id: ObjectId, version: int, changes: dict, move: dict):
+        # writes the changes of a move and adds it to the log, only if the game is still at version
+        result = await games.update_one({"_id": game_id, "version": version},
+                                        {"$set": changes, "$push": {"moves": move}, "$inc": {"version": 1},
+                                         "$currentDate": {"updated_at": True}},
+                                        session=current_session.get())
+        return result.modified_count > 0
+
+    async def persist_games(self, updates: list):
+        # writes (game_id, version, changes, new_moves) for many games at once, each only if the game
+        # is still at that version; returns the ids of the games that weren't
+        writes = [UpdateOne({"_id": game_id, "version": version},
+                            {"$set": changes, "$push": {"moves": {"$each": new_moves}}})
+                  for game_id, version, changes, new_moves in updates]
+        result = await games.bulk_write(writes, ordered=False)
+        if result.matched_count == len(writes):
+            return set()
+
+        expected = {game_id: changes["version"] for game_id, version, changes, new_moves in updates}
+        written = games.find({"_id": {"$in": list(expected)}}, {"version": 1})
+        return set(expected) - {game["_id"] async for game in written if game["version"] == expected[game["_id"]]}
+
+    async def record_result(self, game: dict, state: str):
+        size, winning_line = game["grid_properties"]["size"], game["grid_properties"]["winning_line"]
+        players = (game["x_player_name"], game["o_player_name"])
+        await player_stats.bulk_write([
+            UpdateOne({"username": player, "size": size, "winning_line": winning_line},
+                      {"$inc": {field: 1}, "$setOnInsert": {key: 0 for key in ("wins", "losses", "draws")
+                                                             if key != field}},
+                      upsert=True)
+            for player, field in zip(players, outcome_fields(state))
+        ], ordered=False, session=current_session.get())
+
+    async def claim_result(self, game_id: ObjectId):
+        # the flag isn't part of what clients see, so flipping it doesn't change the version
+        result = await games.update_one({"_id": game_id, "result_recorded": False},
+                                        {"$set": {"result_recorded": True}}, session=current_session.get())
+        return result.modified_count > 0
+
+    async def release_result(self, game_id: ObjectId):
+        await games.update_one({"_id": game_id}, {"$set": {"result_recorded": False}})
+
+    async def find_unrecorded_games(self, cutoff: datetime, limit: int):
+        result = games.find({"result_recorded": False, "updated_at": {"$lt": cutoff}}, GAME_PROJECTION).limit(limit)
+        return [game async for game in result]
+
+    async def find_player_stats(self, username: str):
+        result = player_stats.find({"username": username}, {"_id": 0}).sort([("size", 1), ("winning_line", 1)])
+        return [entry async for entry in result]
+
+    async def find_leaderboard(self, size: int, winning_line: int, limit: int, after: str):
+        # ranked by wins, ties by username; a page starts after the entry of the player named in after
+        search_query = {"size": size, "winning_line": winning_line}
+        if after:
+            last = await player_stats.find_one({**search_query, "username": after}, {"wins": 1})
+            if last is None:
+                return []
+            search_query["$or"] = [{"wins": {"$lt": last["wins"]}}, {"wins": last["wins"], "username": {"$gt": after}}]
+        result = player_stats.find(search_query, {"_id": 0}).sort([("wins", -1), ("username", 1)]).limit(limit)
+        return [entry async for entry in result]
+
+    async def expire_entries(self):
+        # TTL indexes on waiting_users.waiting_since and invitations.finished_at remove these
+        pass
+
+    async def find_stale_games(self, cutoff: datetime, limit: int):
+        result = games.find({"state": "ongoing", "updated_at": {"$lt": cutoff}}, {"_id": 1}).limit(limit)
+        return [game["_id"] async for game in result]
+
+    async def find_bot_turn_games(self, bot_username: str, cutoff: datetime, limit: int):
+        result = games.find({"state": "ongoing", "updated_at": {"$lt": cutoff},
+                             "$or": [{"x_player_name": bot_username, "x_turn": True},
+                                     {"o_player_name": bot_username, "x_turn": False}]},
+                            GAME_PROJECTION).limit(limit)
+        return [game async for game in result]
+
+    async def time_out_game(self, game_id: ObjectId, cutoff: datetime):
+        return await games.find_one_and_update({"_id": game_id, "state": "ongoing", "updated_at": {"$lt": cutoff}},
+                                               {"$set": {"state": "timed_out"}, "$inc": {"version": 1},
+                                                "$currentDate": {"updated_at": True}},
+                                               projection=GAME_PROJECTION, return_document=ReturnDocument.AFTER)
+
+    async def find_finished_games(self, cutoff: datetime, limit: int):
+        result = games.find({"state": {"$in": FINISHED_STATES}, "updated_at": {"$lt": cutoff},
+                             "result_recorded": {"$ne": False}}).limit(limit)
+        return [game async for game in result]
+
+    async def archive_game(self, game: dict):
+        # the history entry is written first and is idempotent, so a game is never lost; the game is
+        # only removed if it didn't change since it was read, otherwise a later pass archives it again
+        await game_history.replace_one({"_id": game["_id"]}, history_entry(game), upsert=True)
+        result = await games.delete_one({"_id": game["_id"], "version": game["version"]})
+        return result.deleted_count > 0
+
+    async def export_games(self, username: str):
+        # finished games that aren't archived yet and archived ones, merged in _id order
+        player_query = {"$or": [{"x_player_name": username}, {"o_player_name": username}]}
+        finished = games.find({**player_query, "state": {"$in": FINISHED_STATES}}, EXPORT_PROJECTION)
+        finished = (history_entry(game) async for game in finished.sort("_id", 1).batch_size(EXPORT_BATCH_SIZE))
+        archived = game_history.find(player_query).sort("_id", 1).batch_size(EXPORT_BATCH_SIZE)
+        async for entry in merge_by_id(finished, archived):
+            yield entry
+
+    async def find_moves(self, game_id: str, since: int):
+        # the log holds the move with sequence number n at position n - 1
+        projection = {"x_player_name": 1, "o_player_name": 1, "state": 1, "move_count": 1,
+                      "moves": {"$slice": [since, MAX_MOVES]}}
+        return await games.find_one({"_id": ObjectId(game_id)}, projection)
+
+
+def after_cursor(documents, limit: int, after: str):
+    # documents are kept in insertion order, which is _id order for ids generated in this process
+    after = ObjectId(after) if after else None
+    page = []
+    for document in documents:
+        if after is None or document["_id"] > after:
+            page.append(dict(document))
+            if len(page) == limit:
+                break
+    return page
+
+
+class MemoryStorage:
+    # Every method runs without awaiting, so each one is atomic on the event loop and no locks
+    # are needed. Stored documents are never changed in place, a change replaces the nested value,
+    # so shallow copies are enough to keep callers from modifying them.
+    def __init__(self):
+        self.users = {}
+        self.waiting_users = {}
+        self.tickets = defaultdict(dict)
+        self.invitations = {}
+        self.invitations_by_player = defaultdict(dict)
+        self.games = {}
+        self.ongoing_games_by_player = defaultdict(dict)
+        self.game_history = {}
+        self.stats_by_player = defaultdict(dict)
+        # per board configuration, (-wins, username) of every player with a record, kept sorted
+        self.leaderboards = defaultdict(list)
+
+    async def start(self):
+        pass
+
+    async def stop(self):
+        pass
+
+    @asynccontextmanager
+    async def transaction(self):
+        # there is nothing to roll back to, as without MONGO_TRANSACTIONS the transition alone decides the winner
+        yield
+
+    async def insert_user(self, user: dict):
+        if user["username"] in self.users:
+            raise DuplicateKeyError("username already exists", 11000)
+        user.setdefault("_id", ObjectId())
+        self.users[user["username"]] = dict(user)
+
+    async def find_user(self, username: str):
+        user = self.users.get(username)
+        return dict(user) if user is not None else None
+
+    async def delete_user(self, username: str):
+        self.users.pop(username, None)
+        for (size, winning_line), entry in self.stats_by_player.pop(username, {}).items():
+            board = self.leaderboards[(size, winning_line)]
+            del board[bisect_left(board, (-entry["wins"], username))]
+
+    async def add_waiting_user(self, username: str):
+        if username in self.waiting_users:
+            raise DuplicateKeyError("username already waiting", 11000)
+        self.waiting_users[username] = {"_id": ObjectId(), "username": username, "waiting_since": now()}
+
+    async def remove_waiting_user(self, username: str):
+        entry = self.waiting_users.pop(username, None)
+        if entry is not None and "matchmaking" in entry:
+            self.tickets[ticket_key(entry)].pop(username, None)
+
+    async def remove_waiting_users(self, usernames: list):
+        for username in usernames:
+            await self.remove_waiting_user(username)
+
+    async def is_waiting(self, username: str):
+        return username in self.waiting_users
+
+    async def find_waiting_users(self, limit: int, after: str):
+        return after_cursor(self.waiting_users.values(), limit, after)
+
+    async def take_ticket(self, username: str):
+        entry = self.waiting_users.get(username)
+        if entry is None or "matchmaking" not in entry:
+            return None
+        await self.remove_waiting_user(username)
+        return dict(entry)
+
+    async def claim_ticket(self, username: str, preferences: dict, game_id: str):
+        queue = self.tickets[tuple(sorted(preferences.items()))]
+        partner = next((name for name in queue if name != username), None)
+        if partner is None:
+            return None
+
+        del queue[partner]
+        ticket = {**self.waiting_users[partner], "matched_game_id": game_id}
+        self.waiting_users[partner] = ticket
+        return dict(ticket)
+
+    async def put_ticket(self, ticket: dict):
+        await self.remove_waiting_user(ticket["username"])
+        ticket = {**ticket, "_id": ObjectId(), "waiting_since": now()}
+        self.waiting_users[ticket["username"]] = ticket
+        if ticket["matched_game_id"] is None:
+            self.tickets[ticket_key(ticket)][ticket["username"]] = ticket
+
+    async def insert_invitation(self, invitation: dict):
+        invitation["_id"] = ObjectId()
+        self.invitations[invitation["_id"]] = dict(invitation)
+        self.index_invitation(self.invitations[invitation["_id"]])
+        return str(invitation["_id"])
+
+    def index_invitation(self, invitation: dict):
+        for role in ("inviter", "invited"):
+            self.invitations_by_player[(role, invitation[role], invitation["status"])][invitation["_id"]] = invitation
+
+    async def find_invitation(self, invitation_id: str):
+        invitation = self.invitations.get(ObjectId(invitation_id))
+        return dict(invitation) if invitation is not None else None
+
+    async def find_invitation_status(self, invitation_id: str):
+        invitation = self.invitations.get(ObjectId(invitation_id))
+        if invitation is None:
+            return None
+        return {"_id": invitation["_id"], **{key: invitation[key] for key in INVITATION_STATUS_PROJECTION}}
+
+    async def find_received_invitations(self, username: str, limit: int, after: str):
+        return after_cursor(self.invitations_by_player.get(("invited", username, "pending"), {}).values(),
+                            limit, after)
+
+    async def find_sent_invitations(self, username: str, limit: int, after: str):
+        return after_cursor(self.invitations_by_player.get(("inviter", username, "pending"), {}).values(),
+                            limit, after)
+
+    async def update_invitation(self, invitation_id: str, changes: dict, conditions: dict = None):
+        invitation = self.invitations.get(ObjectId(invitation_id))
+        if invitation is None or any(invitation.get(key) != value for key, value in (conditions or {}).items()):
+            return None
+
+        self.unindex_invitation(invitation)
+        updated = {**invitation, **changes, "version": invitation["version"] + 1, "finished_at": now()}
+        self.invitations[invitation["_id"]] = updated
+        self.index_invitation(updated)
+        return dict(invitation)
+
+    def unindex_invitation(self, invitation: dict):
+        for role in ("inviter", "invited"):
+            key = (role, invitation[role], invitation["status"])
+            self.invitations_by_player[key].pop(invitation["_id"], None)
+            if not self.invitations_by_player[key]:
+                del self.invitations_by_player[key]
+
+    async def insert_game(self, game: dict):
+        game.setdefault("_id", ObjectId())
+        game["updated_at"] = now()
+        self.games[game["_id"]] = dict(game)
+        for player in (game["x_player_name"], game["o_player_name"]):
+            self.ongoing_games_by_player[player][game["_id"]] = self.games[game["_id"]]
+        return str(game["_id"])
+
+    async def find_game(self, game_id: str):
+        return self.without_moves(self.games.get(ObjectId(game_id)))
+
+    async def find_games(self, game_ids: list):
+        found = (self.games.get(ObjectId(game_id)) for game_id in game_ids)
+        return [self.without_moves(game) for game in found if game is not None]
+
+    def without_moves(self, game: dict):
+        if game is None:
+            return None
+        game = dict(game)
+        del game["moves"]
+        return game
+
+    async def find_ongoing_games(self, username: str, limit: int, after: str):
+        return after_cursor(self.ongoing_games_by_player.get(username, {}).values(), limit, after)
+
+    def replace_game(self, game: dict):
+        self.games[game["_id"]] = game
+        for player in (game["x_player_name"], game["o_player_name"]):
+            ongoing = self.ongoing_games_by_player.get(player)
+            if ongoing is None or game["_id"] not in ongoing:
+                continue
+            if game["state"] == "ongoing":
+                ongoing[game["_id"]] = game
+            else:
+                del ongoing[game["_id"]]
+                if not ongoing:
+                    del self.ongoing_games_by_player[player]
+
+    async def update_game(self, game_id: ObjectId, version: int, changes: dict):
+        game = self.games.get(game_id)
+        if game is None or game["version"] != version:
+            return False
+        self.replace_game({**game, **changes, "version": version + 1, "updated_at": now()})
+        return True
+
+    async def apply_move(self, game_id: ObjectId, version: int, changes: dict, move: dict):
+        game = self.games.get(game_id)
+        if game is None or game["version"] != version:
+            return False
+        self.replace_game({**game, **changes, "moves": game["moves"] + [move], "version": version + 1,
+                           "updated_at": now()})
+        return True
+
+    async def persist_games(self, updates: list):
+        conflicts = set()
+        for game_id, version, changes, new_moves in updates:
+            game = self.games.get(game_id)
+            if game is None or game["version"] != version:
+                conflicts.add(game_id)
+                continue
+            self.replace_game({**game, **changes, "moves": game["moves"] + new_moves})
+        return conflicts
+
+    async def record_result(self, game: dict, state: str):
+        grid = (game["grid_properties"]["size"], game["grid_properties"]["winning_line"])
+        board = self.leaderboards[grid]
+        for player, field in zip((game["x_player_name"], game["o_player_name"]), outcome_fields(state)):
+            entry = self.stats_by_player[player].get(grid)
+            if entry is None:
+                entry = stats_entry(player, *grid)
+            else:
+                del board[bisect_left(board, (-entry["wins"], player))]
+            entry = {**entry, field: entry[field] + 1}
+            self.stats_by_player[player][grid] = entry
+            insort(board, (-entry["wins"], player))
+
+    async def claim_result(self, game_id: ObjectId):
+        game = self.games.get(game_id)
+        if game is None or game.get("result_recorded", True):
+            return False
+        self.replace_game({**game, "result_recorded": True})
+        return True
+
+    async def release_result(self, game_id: ObjectId):
+        game = self.games.get(game_id)
+        if game is not None:
+            self.replace_game({**game, "result_recorded": False})
+
+    async def find_unrecorded_games(self, cutoff: datetime, limit: int):
+        unrecorded = (self.without_moves(game) for game in self.games.values()
+                      if game.get("result_recorded", True) is False and game["updated_at"] < cutoff)
+        return list(islice(unrecorded, limit))
+
+    async def find_player_stats(self, username: str):
+        stats = self.stats_by_player.get(username, {})
+        return [dict(stats[grid]) for grid in sorted(stats)]
+
+    async def find_leaderboard(self, size: int, winning_line: int, limit: int, after: str):
+        grid = (size, winning_line)
+        board = self.leaderboards.get(grid, [])
+        start = 0
+        if after:
+            last = self.stats_by_player.get(after, {}).get(grid)
+            if last is None:
+                return []
+            start = bisect_right(board, (-last["wins"], after))
+        return [dict(self.stats_by_player[username][grid]) for _, username in board[start:start + limit]]
+
+    async def expire_entries(self):
+        # does what the TTL indexes do for the Mongo backend
+        waiting_cutoff = now() - timedelta(seconds=WAITING_USER_TTL_SECONDS)
+        for entry in [entry for entry in self.waiting_users.values() if entry["waiting_since"] < waiting_cutoff]:
+            await self.remove_waiting_user(entry["username"])
+
+        invitation_cutoff = now() - timedelta(seconds=INVITATION_RETENTION_SECONDS)
+        for invitation in [invitation for invitation in self.invitations.values()
+                           if invitation.get("finished_at", invitation_cutoff) < invitation_cutoff]:
+            self.unindex_invitation(invitation)
+            del self.invitations[invitation["_id"]]
+
+    async def find_stale_games(self, cutoff: datetime, limit: int):
+        stale = (game["_id"] for game in self.games.values()
+                 if game["state"] == "ongoing" and game["updated_at"] < cutoff)
+        return list(islice(stale, limit))
+
+    async def find_bot_turn_games(self, bot_username: str, cutoff: datetime, limit: int):
+        waiting = (self.without_moves(game) for game in self.games.values()
+                   if game["state"] == "ongoing" and game["updated_at"] < cutoff
+                   and game["x_player_name" if game["x_turn"] else "o_player_name"] == bot_username)
+        return list(islice(waiting, limit))
+
+    async def time_out_game(self, game_id: ObjectId, cutoff: datetime):
+        game = self.games.get(game_id)
+        if game is None or game["state"] != "ongoing" or game["updated_at"] >= cutoff:
+            return None
+        updated = {**game, "state": "timed_out", "version": game["version"] + 1, "updated_at": now()}
+        self.replace_game(updated)
+        return self.without_moves(updated)
+
+    async def find_finished_games(self, cutoff: datetime, limit: int):
+        finished = (dict(game) for game in self.games.values()
+                    if game["state"] in FINISHED_STATES and game["updated_at"] < cutoff and
+                    game.get("result_recorded", True) is not False)
+        return list(islice(finished, limit))
+
+    async def archive_game(self, game: dict):
+        self.game_history[game["_id"]] = history_entry(game)
+        stored = self.games.get(game["_id"])
+        if stored is None or stored["version"] != game["version"]:
+            return False
+        del self.games[game["_id"]]
+        return True
+
+    async def export_games(self, username: str):
+        async def finished():
+            for game in list(self.games.values()):
+                if game["state"] in FINISHED_STATES and username in (game["x_player_name"], game["o_player_name"]):
+                    yield history_entry(game)
+
+        async def archived():
+            for entry in sorted(self.game_history.values(), key=lambda entry: entry["_id"]):
+                if username in (entry["x_player_name"], entry["o_player_name"]):
+                    yield dict(entry)
+
+        async for entry in merge_by_id(finished(), archived()):
+            yield entry
+
+    async def find_moves(self, game_id: str, since: int):
+        game = self.games.get(ObjectId(game_id))
+        if game is None:
+            return None
+        return {**self.without_moves(game), "moves": game["moves"][since:since + MAX_MOVES]}
+
+
+def ticket_key(ticket: dict):
+    return tuple(sorted(ticket["matchmaking"].items()))
+
+
+store = MemoryStorage() if STORAGE_BACKEND == "memory" else MongoStorage()
+
+
+async def count_result(game: dict):
+    # A decided game is written with result_recorded false, and whoever claims it first counts the
+    # result in the players' records. If counting fails the claim is given back, with MONGO_TRANSACTIONS
+    # it is rolled back, and the archiver counts the result on a later pass.
+    try:
+        async with store.transaction():
+            if await store.claim_result(game["_id"]):
+                await store.record_result(game, game["state"])
+    except BaseException:
+        # a cancelled count gives its claim back too
+        if not MONGO_TRANSACTIONS:
+            await store.release_result(game["_id"])
+        raise
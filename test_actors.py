@@ -0,0 +1,203 @@
+import asyncio
+import os
+import unittest
+from unittest import mock
+
+# the backend and the move path are picked when the modules are imported; flushes only happen
+# when a test asks for one
+os.environ["STORAGE_BACKEND"] = "memory"
+os.environ["GAME_ACTORS"] = "1"
+os.environ["ACTOR_FLUSH_SECONDS"] = "3600"
+
+from bson import ObjectId
+from pymongo.errors import AutoReconnect
+import actors
+from storage import store
+from game import create_game, apply_move, update_game, find_game, parse_cell
+from bitboard import MAX_GRID_SIZE
+
+
+async def move(game_id: str, username: str, cell: str):
+    return await apply_move(game_id, username, cell, parse_cell(cell, MAX_GRID_SIZE))
+
+
+def stored(game_id: str):
+    return store.games[ObjectId(game_id)]
+
+
+class ActorTest(unittest.IsolatedAsyncioTestCase):
+    async def asyncSetUp(self):
+        store.__init__()
+        actors.actors.clear()
+        self.game_id = await create_game("xplayer", "oplayer", 3, 3, "same")
+
+    async def play_to_x_win(self):
+        for username, cell in [("xplayer", "a1"), ("oplayer", "b1"), ("xplayer", "a2"), ("oplayer", "b2")]:
+            await move(self.game_id, username, cell)
+        return await move(self.game_id, "xplayer", "a3")
+
+    async def test_moves_are_held_until_flushed(self):
+        await move(self.game_id, "xplayer", "a1")
+        self.assertEqual(stored(self.game_id)["move_count"], 0)
+
+        await actors.flush()
+        game = stored(self.game_id)
+        self.assertEqual(game["move_count"], 1)
+        self.assertEqual(game["version"], 1)
+        self.assertEqual([entry["cell"] for entry in game["moves"]], ["a1"])
+
+    async def test_failed_flush_keeps_changes_for_the_next_one(self):
+        await move(self.game_id, "xplayer", "a1")
+        with mock.patch.object(store, "persist_games", side_effect=AutoReconnect("connection lost")):
+            with self.assertRaises(AutoReconnect):
+                await actors.flush()
+
+        actor = actors.actors[self.game_id]
+        self.assertEqual(actor.saved_version, 0)
+        self.assertEqual([entry["cell"] for entry in actor.new_moves], ["a1"])
+        self.assertEqual(stored(self.game_id)["move_count"], 0)
+
+        await move(self.game_id, "oplayer", "b1")
+        await actors.flush()
+        game = stored(self.game_id)
+        self.assertEqual(game["version"], 2)
+        self.assertEqual([entry["cell"] for entry in game["moves"]], ["a1", "b1"])
+        self.assertEqual(actor.changes, {})
+
+    async def test_cancelled_flush_keeps_changes_and_moves_made_during_it(self):
+        await move(self.game_id, "xplayer", "a1")
+        started = asyncio.Event()
+
+        async def hang(updates):
+            started.set()
+            await asyncio.Event().wait()
+
+        with mock.patch.object(store, "persist_games", side_effect=hang):
+            flushing = asyncio.create_task(actors.flush())
+            await started.wait()
+            await move(self.game_id, "oplayer", "b1")
+            flushing.cancel()
+            with self.assertRaises(asyncio.CancelledError):
+                await flushing
+
+        await actors.flush()
+        game = stored(self.game_id)
+        self.assertEqual(game["version"], 2)
+        self.assertEqual(game["move_count"], 2)
+        self.assertEqual([entry["cell"] for entry in game["moves"]], ["a1", "b1"])
+
+    async def test_version_conflict_drops_the_actor(self):
+        await move(self.game_id, "xplayer", "a1")
+        # another process changes the game while this actor holds an unwritten move
+        await store.update_game(ObjectId(self.game_id), 0, {"play_again_status": "requested_by_o"})
+
+        await actors.flush()
+        self.assertNotIn(self.game_id, actors.actors)
+        game = stored(self.game_id)
+        self.assertEqual(game["move_count"], 0)
+        self.assertEqual(game["play_again_status"], "requested_by_o")
+
+        # the next move starts a new actor from what is in the database
+        self.assertEqual((await find_game(self.game_id))["move_count"], 0)
+        self.assertIsNotNone(await move(self.game_id, "xplayer", "a1"))
+        self.assertEqual(actors.actors[self.game_id].saved_version, 1)
+
+    async def test_updates_are_conditional_on_the_actors_version(self):
+        await move(self.game_id, "xplayer", "a1")
+        game = await find_game(self.game_id)
+        self.assertFalse(await update_game({**game, "version": 0}, {"play_again_status": "requested_by_x"}))
+        self.assertTrue(await update_game(game, {"play_again_status": "requested_by_x"}))
+
+        await actors.flush()
+        self.assertEqual(stored(self.game_id)["play_again_status"], "requested_by_x")
+        self.assertEqual(stored(self.game_id)["version"], 2)
+
+    async def test_result_is_recorded_only_once_the_game_is_written(self):
+        self.assertEqual((await self.play_to_x_win())["state"], "won_by_x")
+        self.assertEqual(await store.find_player_stats("xplayer"), [])
+
+        with mock.patch.object(store, "persist_games", side_effect=AutoReconnect("connection lost")):
+            with self.assertRaises(AutoReconnect):
+                await actors.flush()
+        self.assertEqual(await store.find_player_stats("xplayer"), [])
+
+        await actors.flush()
+        await actors.flush()
+        self.assertEqual(stored(self.game_id)["state"], "won_by_x")
+        [entry] = await store.find_player_stats("xplayer")
+        self.assertEqual((entry["wins"], entry["losses"]), (1, 0))
+        [entry] = await store.find_player_stats("oplayer")
+        self.assertEqual((entry["wins"], entry["losses"]), (0, 1))
+
+    async def test_result_that_fails_to_count_is_kept_without_holding_up_others(self):
+        first_game_id = self.game_id
+        await self.play_to_x_win()
+        self.game_id = await create_game("xplayer", "oplayer", 3, 3, "same")
+        await self.play_to_x_win()
+
+        record_result = store.record_result
+        failures = []
+
+        async def fail_first(game: dict, state: str):
+            if game["_id"] == ObjectId(first_game_id) and not failures:
+                failures.append(game["_id"])
+                raise AutoReconnect("connection lost")
+            await record_result(game, state)
+
+        with mock.patch.object(store, "record_result", side_effect=fail_first):
+            await actors.flush()
+        self.assertEqual(failures, [ObjectId(first_game_id)])
+        [entry] = await store.find_player_stats("xplayer")
+        self.assertEqual(entry["wins"], 1)
+        self.assertEqual(actors.actors[first_game_id].written_result, "won_by_x")
+
+        await actors.flush()
+        await actors.flush()
+        [entry] = await store.find_player_stats("xplayer")
+        self.assertEqual(entry["wins"], 2)
+        [entry] = await store.find_player_stats("oplayer")
+        self.assertEqual(entry["losses"], 2)
+
+    async def test_result_is_kept_when_counting_is_cancelled(self):
+        await self.play_to_x_win()
+        started = asyncio.Event()
+
+        async def hang(game: dict, state: str):
+            started.set()
+            await asyncio.Event().wait()
+
+        with mock.patch.object(store, "record_result", side_effect=hang):
+            flushing = asyncio.create_task(actors.flush())
+            await started.wait()
+            flushing.cancel()
+            with self.assertRaises(asyncio.CancelledError):
+                await flushing
+        self.assertEqual(await store.find_player_stats("xplayer"), [])
+
+        await actors.flush()
+        [entry] = await store.find_player_stats("xplayer")
+        self.assertEqual(entry["wins"], 1)
+
+    async def test_result_of_a_conflicting_game_is_not_recorded(self):
+        await self.play_to_x_win()
+        await store.update_game(ObjectId(self.game_id), 0, {"play_again_status": "requested_by_o"})
+
+        await actors.flush()
+        self.assertNotIn(self.game_id, actors.actors)
+        self.assertEqual(stored(self.game_id)["state"], "ongoing")
+        self.assertEqual(await store.find_player_stats("xplayer"), [])
+
+    async def test_shutdown_flushes_what_is_still_held(self):
+        await actors.start_actors()
+        await move(self.game_id, "xplayer", "a1")
+        self.assertEqual(stored(self.game_id)["move_count"], 0)
+
+        await actors.stop_actors()
+        self.assertTrue(actors.flusher.done())
+        game = stored(self.game_id)
+        self.assertEqual(game["move_count"], 1)
+        self.assertEqual([entry["cell"] for entry in game["moves"]], ["a1"])
+
+
+if __name__ == "__main__":
+    unittest.main()